@@ -0,0 +1,138 @@
+"""Authentication audit log.
+
+Handlers call ``record()``, which only appends to a bounded in-memory queue.
+A background task drains the queue and writes events to ``audit_events``
+with COPY, once AUDIT_BATCH_SIZE events are waiting or AUDIT_FLUSH_INTERVAL
+seconds after the first one arrived. When the queue is full, new events are
+dropped and counted rather than slowing requests down. Whatever is queued at
+shutdown is flushed before the pool closes.
+"""
+import asyncio
+import datetime
+import os
+
+import psycopg
+
+from metrics import gauge, timed
+from model.database import DatabaseUnavailable, get_pool
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1"))
+
+AUDIT_COLUMNS = ("occurred_at", "event", "outcome", "user_id", "email", "ip", "detail")
+
+# Created by start_writer, so the queue belongs to the serving event loop
+_queue = None
+_writer = None
+_flush_task = None
+# Events taken off the queue and not yet written
+_pending = []
+_written = 0
+_dropped = 0
+_failed = 0
+
+
+def record(event: str, outcome: str, email=None, user_id=None, ip=None, detail=None):
+    """Queue an audit event; never blocks and never raises"""
+    global _dropped
+    if _queue is None:
+        return
+    try:
+        _queue.put_nowait((
+            datetime.datetime.now(datetime.timezone.utc), event, outcome, user_id, email, ip, detail
+        ))
+    except asyncio.QueueFull:
+        _dropped += 1
+
+
+async def _write(batch):
+    global _written, _failed
+    try:
+        pool = await get_pool()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                with timed("audit_flush"):
+                    async with cur.copy(
+                        f"COPY audit_events ({', '.join(AUDIT_COLUMNS)}) FROM STDIN"
+                    ) as copy:
+                        for row in batch:
+                            await copy.write_row(row)
+            await conn.commit()
+        _written += len(batch)
+    except (psycopg.Error, DatabaseUnavailable, RuntimeError):
+        # Audit writes must not take the service down; count what was lost
+        _failed += len(batch)
+
+
+def _drain():
+    while len(_pending) < AUDIT_BATCH_SIZE:
+        try:
+            _pending.append(_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+
+
+async def _flush():
+    batch = _pending[:]
+    _pending.clear()
+    await _write(batch)
+
+
+async def _run():
+    global _flush_task
+    loop = asyncio.get_running_loop()
+    while True:
+        _pending.append(await _queue.get())
+        deadline = loop.time() + AUDIT_FLUSH_INTERVAL
+        _drain()
+        while len(_pending) < AUDIT_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                _pending.append(await asyncio.wait_for(_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+            _drain()
+        # Shielded so stopping the writer can't cut a COPY off half way
+        _flush_task = asyncio.ensure_future(_flush())
+        await asyncio.shield(_flush_task)
+
+
+def start_writer():
+    global _queue, _writer
+    if _writer is None:
+        _queue = asyncio.Queue(maxsize=AUDIT_QUEUE_SIZE)
+        _writer = asyncio.create_task(_run())
+
+
+async def stop_writer():
+    """Stop the background writer and flush everything still queued"""
+    global _queue, _writer
+    if _writer is None:
+        return
+    _writer.cancel()
+    try:
+        await _writer
+    except asyncio.CancelledError:
+        pass
+    _writer = None
+    if _flush_task is not None:
+        await _flush_task
+
+    _drain()
+    while _pending:
+        await _flush()
+        _drain()
+    _queue = None
+
+
+@gauge("audit_events", "Audit events by state: queued, written, dropped (queue full), failed (write error)")
+def _audit_counts():
+    return [
+        ({"state": "queued"}, _queue.qsize() if _queue is not None else 0),
+        ({"state": "written"}, _written),
+        ({"state": "dropped"}, _dropped),
+        ({"state": "failed"}, _failed),
+    ]
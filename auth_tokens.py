@@ -0,0 +1,188 @@
+import datetime
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import List
+
+import jwt
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from psycopg_pool import AsyncConnectionPool
+from pydantic import BaseModel
+
+from google_auth import ALGORITHM, SECRET_KEY, create_access_token
+from model.database import get_pool
+from sessions import ExpiryWheel, end_session, is_session_revoked, rotate_session
+
+router = APIRouter(tags=["tokens"])
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+INTROSPECT_BATCH_MAX = 100
+REFRESHED_TOKEN_EXPIRE_MINUTES = 60
+
+# token digest -> (claims, exp). Ordered oldest-used first for LRU eviction.
+_verified = OrderedDict()
+# token digest -> exp, dropped by the wheel once the token would be expired anyway
+_revoked = {}
+_revoked_wheel = ExpiryWheel()
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+class TokenIntrospect(BaseModel):
+    token: str
+
+
+class TokenIntrospectBatch(BaseModel):
+    tokens: List[str]
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def _unauthorized(detail: str):
+    return HTTPException(
+        status_code=401,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def _evict_revoked(now):
+    for key in _revoked_wheel.pop_expired(now):
+        _revoked.pop(key, None)
+
+
+def verify_token(token: str) -> dict:
+    """Return the claims of a token issued by create_access_token.
+
+    Already-verified tokens are served from an LRU cache until their ``exp``,
+    so repeat checks skip the HMAC and JSON decode.
+    """
+    key = _digest(token)
+    now = time.time()
+
+    _evict_revoked(now)
+    if key in _revoked:
+        raise _unauthorized("Token has been revoked")
+
+    cached = _verified.get(key)
+    if cached is not None:
+        claims, exp = cached
+        if exp > now:
+            if is_session_revoked(claims.get("sid")):
+                raise _unauthorized("Session has ended")
+            _verified.move_to_end(key)
+            return claims
+        del _verified[key]
+        raise _unauthorized("Token has expired")
+
+    try:
+        claims = jwt.decode(
+            token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp"]}
+        )
+    except jwt.ExpiredSignatureError:
+        raise _unauthorized("Token has expired")
+    except jwt.InvalidTokenError:
+        raise _unauthorized("Invalid token")
+
+    if is_session_revoked(claims.get("sid")):
+        raise _unauthorized("Session has ended")
+
+    _verified[key] = (claims, claims["exp"])
+    if len(_verified) > TOKEN_CACHE_SIZE:
+        _verified.popitem(last=False)
+    return claims
+
+
+def revoke_token(token: str):
+    """Reject ``token`` from now on, even though its signature is still valid"""
+    key = _digest(token)
+    now = time.time()
+    try:
+        exp = jwt.decode(
+            token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False}
+        )["exp"]
+    except (jwt.InvalidTokenError, KeyError):
+        return
+
+    _verified.pop(key, None)
+    _evict_revoked(now)
+    if exp > now:
+        _revoked[key] = exp
+        _revoked_wheel.add(key, exp)
+
+
+def is_revoked(token: str) -> bool:
+    return _digest(token) in _revoked
+
+
+async def current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+) -> dict:
+    """Dependency returning the verified claims of the request's bearer token"""
+    if credentials is None or credentials.scheme.lower() != "bearer":
+        raise _unauthorized("Not authenticated")
+    return verify_token(credentials.credentials)
+
+
+def _introspect(token: str) -> dict:
+    try:
+        claims = verify_token(token)
+    except HTTPException:
+        return {"active": False}
+    return {"active": True, **claims}
+
+
+@router.post("/introspect")
+async def introspect(body: TokenIntrospect):
+    """Report whether a token is active, RFC 7662 style"""
+    return _introspect(body.token)
+
+
+@router.post("/introspect/batch")
+async def introspect_batch(body: TokenIntrospectBatch):
+    if len(body.tokens) > INTROSPECT_BATCH_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {INTROSPECT_BATCH_MAX} tokens per request",
+        )
+    return {"results": [_introspect(token) for token in body.tokens]}
+
+
+@router.post("/token/refresh")
+async def refresh(body: RefreshRequest, db: AsyncConnectionPool = Depends(get_pool)):
+    """Trade a refresh token for a new access token and a new refresh token.
+
+    Each refresh token works once; presenting a used one again ends the
+    whole session.
+    """
+    session, refresh_token = await rotate_session(db, body.refresh_token)
+    access_token = create_access_token(
+        data={"sub": session.subject, "sid": session.family},
+        expires_delta=datetime.timedelta(minutes=REFRESHED_TOKEN_EXPIRE_MINUTES)
+    )
+    return {
+        "status": "success",
+        "token": access_token,
+        "refresh_token": refresh_token,
+    }
+
+
+@router.post("/logout")
+async def logout(
+    body: RefreshRequest,
+    credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme),
+    db: AsyncConnectionPool = Depends(get_pool),
+):
+    """End the session behind a refresh token, and revoke the bearer token if one is sent"""
+    await end_session(db, body.refresh_token)
+    if credentials is not None and credentials.scheme.lower() == "bearer":
+        revoke_token(credentials.credentials)
+    return {"status": "success", "message": "Logged out"}
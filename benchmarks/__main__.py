@@ -0,0 +1,45 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from benchmarks.load import ROUTES, run_load
+from benchmarks.micro import run_micro
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    micro = sub.add_parser("micro", help="time hot-path functions in isolation")
+    micro.add_argument("--min-time", type=float, default=0.5, help="seconds per benchmark")
+
+    load = sub.add_parser("load", help="drive every route of main:app concurrently")
+    load.add_argument("--routes", default=",".join(ROUTES), help="comma-separated subset of routes")
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--requests", type=int, default=200, help="requests per route")
+    load.add_argument("--users", type=int, default=None, help="seeded accounts (default: concurrency)")
+
+    for command in (micro, load):
+        command.add_argument("--output", help="write the JSON report here instead of stdout")
+
+    args = parser.parse_args(argv)
+    if args.command == "micro":
+        report = run_micro(args.min_time)
+    else:
+        routes = [route for route in args.routes.split(",") if route]
+        unknown = set(routes) - set(ROUTES)
+        if unknown:
+            parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+        report = asyncio.run(run_load(routes, args.concurrency, args.requests, args.users))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+
+import httpx
+import pyotp
+
+import benchmarks  # noqa: F401  (sets the benchmark environment first)
+from benchmarks.google_mock import GoogleMock
+from benchmarks.stats import summarize
+
+ROUTES = ("signup", "login", "verify_mfa", "setup_mfa", "get_user", "google_callback")
+PASSWORD = "bench-password-123"
+COMPANY_URL = "http://localhost:3000"
+
+
+class LoadTest:
+    """Drives main:app in-process through httpx.ASGITransport.
+
+    Needs a reachable Postgres in DATABASE_URL with the schema applied. Every
+    account it creates uses a per-run email prefix and is deleted afterwards.
+    """
+
+    def __init__(self, users: int):
+        self.run_id = uuid.uuid4().hex[:8]
+        self.users = [self._email("user", n) for n in range(users)]
+        self.setup_users = [self._email("setup", n) for n in range(users)]
+        self.google_users = [self._email("google", n) for n in range(users)]
+        self.secrets = {}
+        # Accounts not in the middle of a verify_mfa request, see drive()
+        self.idle_mfa_users = None
+        self.state = urllib.parse.quote(json.dumps({"company_url": COMPANY_URL}))
+        self._signups = 0
+
+    def _email(self, kind, n):
+        return f"bench-{self.run_id}-{kind}-{n}@example.com"
+
+    def request_for(self, route, i, email=None):
+        """(method, url, kwargs) for the i-th request to ``route``"""
+        if route == "signup":
+            self._signups += 1
+            return "POST", "/signup", {
+                "json": {"email": self._email("signup", self._signups), "password": PASSWORD, "name": "Bench"}
+            }
+        if route == "login":
+            email = self.users[i % len(self.users)]
+            return "POST", "/login", {"json": {"email": email, "password": PASSWORD}}
+        if route == "verify_mfa":
+            code = pyotp.TOTP(self.secrets[email]).now()
+            return "POST", "/verify_mfa", {"params": {"email": email, "code": code}}
+        if route == "setup_mfa":
+            email = self.setup_users[i % len(self.setup_users)]
+            return "POST", "/setup_mfa", {"params": {"email": email}}
+        if route == "get_user":
+            email = self.users[i % len(self.users)]
+            return "GET", f"/user/{email}", {}
+        if route == "google_callback":
+            return "GET", "/auth/google/callback", {
+                "params": {"code": str(i % len(self.google_users)), "state": self.state}
+            }
+        raise ValueError(f"Unknown route {route!r}")
+
+    async def seed(self, client):
+        for email in self.users + self.setup_users:
+            response = await client.post(
+                "/signup", json={"email": email, "password": PASSWORD, "name": "Bench"}
+            )
+            response.raise_for_status()
+        for email in self.users:
+            response = await client.post("/setup_mfa", params={"email": email, "qr_format": "url"})
+            response.raise_for_status()
+            uri = response.json()["uri"]
+            self.secrets[email] = urllib.parse.parse_qs(urllib.parse.urlparse(uri).query)["secret"][0]
+            # Enrollment stays pending until the first code is verified
+            response = await client.post(
+                "/verify_mfa", params={"email": email, "code": pyotp.TOTP(self.secrets[email]).now()}
+            )
+            response.raise_for_status()
+        self.idle_mfa_users = asyncio.Queue()
+        for email in self.users:
+            self.idle_mfa_users.put_nowait(email)
+
+    async def reset_replay(self, email):
+        """Let an account use the current code again, here and in the database"""
+        from model.database import get_pool
+        from totp_engine import totp_verifier
+
+        for used in totp_verifier._consumed.values():
+            used.discard(email)
+        pool = await get_pool()
+        async with pool.connection() as conn:
+            await conn.execute("UPDATE users SET totp_last_step = NULL WHERE email = %s", (email,))
+            await conn.commit()
+
+    async def cleanup(self):
+        from model.database import get_pool
+
+        pool = await get_pool()
+        async with pool.connection() as conn:
+            await conn.execute("DELETE FROM users WHERE email LIKE %s", (f"bench-{self.run_id}-%",))
+            await conn.commit()
+
+    async def drive(self, client, route, total, concurrency):
+        latencies = []
+        statuses = Counter()
+        indexes = iter(range(total))
+
+        async def worker():
+            for i in indexes:
+                email = None
+                if route == "verify_mfa":
+                    # Replay protection accepts each code once, so every timed request
+                    # needs an account that is idle and whose used steps were forgotten,
+                    # outside the timing
+                    email = await self.idle_mfa_users.get()
+                    await self.reset_replay(email)
+                try:
+                    method, url, kwargs = self.request_for(route, i, email)
+                    start = time.perf_counter()
+                    response = await client.request(method, url, **kwargs)
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] += 1
+                finally:
+                    if email is not None:
+                        self.idle_mfa_users.put_nowait(email)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return summarize(latencies, time.perf_counter() - start, statuses)
+
+
+async def run_load(routes=ROUTES, concurrency=16, requests=200, users=None):
+    import google_client
+    from google_auth import GOOGLE_CLIENT_ID
+    from main import app
+
+    test = LoadTest(users or concurrency)
+    google_client.open_client(GoogleMock(GOOGLE_CLIENT_ID, test.google_users).transport())
+
+    report = {
+        "concurrency": concurrency,
+        "requests_per_route": requests,
+        "routes": {},
+    }
+    async with app.router.lifespan_context(app):
+        # Unhandled errors become 500s in the report rather than aborting the run
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            try:
+                await test.seed(client)
+                for route in routes:
+                    result = await test.drive(client, route, requests, concurrency)
+                    if route == "verify_mfa" and set(result["status_codes"]) != {"200"}:
+                        # Otherwise the percentiles would time the rejection path
+                        raise RuntimeError(f"verify_mfa returned {result['status_codes']}, expected only 200s")
+                    report["routes"][route] = result
+            finally:
+                await test.cleanup()
+    return report
@@ -0,0 +1,62 @@
+import time
+
+import pyotp
+
+import benchmarks  # noqa: F401  (sets the benchmark environment first)
+
+PASSWORD = b"bench-password-123"
+QR_URI = pyotp.TOTP(pyotp.random_base32()).provisioning_uri(
+    name="bench@example.com", issuer_name="MyAuthApp"
+)
+
+
+def measure(fn, min_time=0.5):
+    """Call ``fn`` repeatedly for at least ``min_time`` seconds"""
+    fn()
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return {
+        "calls": calls,
+        "mean_us": round(elapsed / calls * 1e6, 3),
+        "ops_per_s": round(calls / elapsed, 1),
+    }
+
+
+def run_micro(min_time=0.5):
+    import auth_tokens
+    import password_hashing
+    import qr_codes
+    from google_auth import create_access_token
+    from totp_engine import TOTPVerifier
+
+    token = create_access_token({"sub": "1"})
+    hashed = password_hashing._hash(PASSWORD)
+
+    def verify_uncached():
+        auth_tokens._verified.clear()
+        auth_tokens.verify_token(token)
+
+    secret = pyotp.random_base32()
+    totp = pyotp.TOTP(secret)
+    verifier = TOTPVerifier()
+    verifier.store_secret("bench@example.com", secret)
+    code = totp.now()
+
+    benches = {
+        "create_access_token": lambda: create_access_token({"sub": "1"}),
+        "verify_token_uncached": verify_uncached,
+        "verify_token_cached": lambda: auth_tokens.verify_token(token),
+        "bcrypt_hash": lambda: password_hashing._hash(PASSWORD),
+        "bcrypt_check": lambda: password_hashing._check(PASSWORD, hashed),
+        # Replays are rejected after the first call, which still walks the full check
+        "totp_verify_engine": lambda: verifier.verify("bench@example.com", code),
+        "totp_verify_pyotp": lambda: pyotp.TOTP(secret).verify(code, valid_window=1),
+        "qr_render_png": lambda: qr_codes._render(QR_URI, "png"),
+        "qr_render_svg": lambda: qr_codes._render(QR_URI, "svg"),
+    }
+    return {name: measure(fn, min_time) for name, fn in benches.items()}
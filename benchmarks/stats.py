@@ -0,0 +1,26 @@
+import math
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, elapsed, statuses=None):
+    """Latency percentiles in milliseconds plus throughput for one run"""
+    ordered = sorted(latencies)
+    summary = {
+        "requests": len(ordered),
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(len(ordered) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None,
+    }
+    for pct in (50, 95, 99):
+        value = percentile(ordered, pct)
+        summary[f"p{pct}_ms"] = round(value * 1000, 3) if value is not None else None
+    if statuses is not None:
+        summary["status_codes"] = {str(code): count for code, count in sorted(statuses.items())}
+    return summary
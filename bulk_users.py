@@ -0,0 +1,295 @@
+"""Bulk user import and export over Postgres COPY.
+
+    python -m bulk_users import users.csv
+    python -m bulk_users import users.ndjson --format ndjson
+    python -m bulk_users export users.csv [--include-password-hashes]
+
+Input rows carry ``email``, ``name`` and either a plaintext ``password``
+(hashed on the shared password-hashing pool) or an existing bcrypt
+``password_hash``. Rows are split on newlines, so fields can't contain
+embedded line breaks.
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import hmac
+import json
+import os
+import re
+import sys
+from typing import Literal
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+import email_index
+from model.database import close_pool, get_pool, open_pool
+from password_hashing import encode_stored_hash, hash_passwords, shutdown_executor
+
+router = APIRouter(prefix="/admin/users", tags=["admin"])
+
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "5000"))
+
+BCRYPT_HASH = re.compile(r"^\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}$")
+
+EXPORT_COLUMNS = "id, email, username, is_google_user, mfa_enabled, created_at"
+# users.password holds the bcrypt string, or legacy "\x<hex>" text until
+# the user next logs in; export the bcrypt string either way
+EXPORT_PASSWORD_HASH = (
+    "CASE WHEN left(password, 2) = '\\x' "
+    "THEN convert_from(decode(substr(password, 3), 'hex'), 'UTF8') "
+    "ELSE password END AS password_hash"
+)
+
+
+async def require_admin(x_admin_key: str | None = Header(None)):
+    """Admin endpoints are disabled unless ADMIN_API_KEY is set"""
+    if not ADMIN_API_KEY or not x_admin_key or not hmac.compare_digest(x_admin_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=403, detail="Admin key required")
+
+
+def _parse_rows(lines, fmt, header, first_line):
+    """Yield (line number, record dict or error message) for a batch of lines"""
+    if fmt == "csv":
+        for offset, values in enumerate(csv.reader(lines)):
+            if not values:
+                continue
+            if len(values) > len(header):
+                yield first_line + offset, "Too many columns"
+                continue
+            yield first_line + offset, dict(zip(header, values))
+    else:
+        for offset, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield first_line + offset, "Invalid JSON"
+                continue
+            if not isinstance(record, dict):
+                yield first_line + offset, "Expected a JSON object"
+                continue
+            yield first_line + offset, record
+
+
+def _validate(record):
+    for field in ("email", "password", "password_hash", "name"):
+        if record.get(field) is not None and not isinstance(record[field], str):
+            return f"{field} must be a string"
+    email = (record.get("email") or "").strip()
+    password = record.get("password") or None
+    password_hash = record.get("password_hash") or None
+    if not email or "@" not in email:
+        return "Invalid email"
+    if password and password_hash:
+        return "Give either password or password_hash, not both"
+    if password_hash and not BCRYPT_HASH.match(password_hash):
+        return "password_hash is not a bcrypt hash"
+    if not password and not password_hash:
+        return "Missing password or password_hash"
+    if password and len(password.encode("utf-8")) > 72:
+        return "Password longer than 72 bytes"
+    return None
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.rows = []
+
+    def problem(self, line, email, status, message):
+        if status == "duplicate":
+            self.duplicates += 1
+        else:
+            self.errors += 1
+        self.rows.append({"line": line, "email": email, "status": status, "message": message})
+
+    def as_dict(self):
+        return {
+            "status": "success",
+            "created": self.created,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "rows": self.rows,
+        }
+
+
+class UserImporter:
+    """Hashes, COPYs and inserts one batch of rows at a time"""
+
+    def __init__(self, db, fmt: Literal["csv", "ndjson"]):
+        self.db = db
+        self.fmt = fmt
+        self.report = ImportReport()
+        self.header = None
+        self.seen = set()
+        self.line_number = 0
+
+    async def load_batch(self, lines):
+        first_line = self.line_number + 1
+        self.line_number += len(lines)
+        if self.fmt == "csv" and self.header is None:
+            header_line, lines = lines[0], lines[1:]
+            self.header = [column.strip() for column in next(csv.reader([header_line]))]
+            first_line += 1
+
+        rows = []
+        to_hash = []
+        for line, record in _parse_rows(lines, self.fmt, self.header, first_line):
+            if isinstance(record, str):
+                self.report.problem(line, None, "error", record)
+                continue
+            error = _validate(record)
+            email = (record.get("email") or "").strip()
+            if error:
+                self.report.problem(line, email or None, "error", error)
+                continue
+            if email.lower() in self.seen:
+                self.report.problem(line, email, "duplicate", "Email repeated in this import")
+                continue
+            self.seen.add(email.lower())
+            row = [line, email, record.get("password_hash") or None, record.get("name") or None]
+            if row[2] is None:
+                to_hash.append((row, record["password"]))
+            rows.append(row)
+
+        if to_hash:
+            hashes = await hash_passwords([password for _, password in to_hash])
+            for (row, _), hashed in zip(to_hash, hashes):
+                row[2] = hashed.decode()
+
+        if rows:
+            await self._insert(rows)
+
+    async def _insert(self, rows):
+        async with self.db.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """CREATE TEMP TABLE IF NOT EXISTS users_import (
+                           line INTEGER, email TEXT, password TEXT, username TEXT
+                       ) ON COMMIT DELETE ROWS"""
+                )
+                async with cur.copy(
+                    "COPY users_import (line, email, password, username) FROM STDIN"
+                ) as copy:
+                    for line, email, password_hash, name in rows:
+                        await copy.write_row(
+                            (line, email, encode_stored_hash(password_hash.encode()), name)
+                        )
+                await cur.execute(
+                    """INSERT INTO users (email, password, username)
+                       SELECT email, password, username FROM users_import ORDER BY line
+                       ON CONFLICT (email) DO NOTHING
+                       RETURNING email"""
+                )
+                created = {email for (email,) in await cur.fetchall()}
+            await conn.commit()
+
+        self.report.created += len(created)
+        for email in created:
+            email_index.add(email)
+        for line, email, _, _ in rows:
+            if email not in created:
+                self.report.problem(line, email, "duplicate", "Email already registered")
+
+
+async def import_users(db, lines, fmt="csv"):
+    """Import users from an async iterable of text lines and return the report"""
+    importer = UserImporter(db, fmt)
+    batch = []
+    async for line in lines:
+        batch.append(line)
+        if len(batch) >= BULK_BATCH_SIZE:
+            await importer.load_batch(batch)
+            batch = []
+    if batch:
+        await importer.load_batch(batch)
+    return importer.report.as_dict()
+
+
+async def export_users(db, include_password_hashes=False):
+    """Yield the users table as CSV chunks straight from COPY TO STDOUT"""
+    columns = EXPORT_COLUMNS
+    if include_password_hashes:
+        columns += ", " + EXPORT_PASSWORD_HASH
+    async with db.connection() as conn:
+        async with conn.cursor() as cur:
+            async with cur.copy(
+                f"COPY (SELECT {columns} FROM users ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)"
+            ) as copy:
+                async for chunk in copy:
+                    yield bytes(chunk)
+
+
+async def _request_lines(request: Request):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+@router.post("/import", dependencies=[Depends(require_admin)])
+async def bulk_import(request: Request, format: Literal["csv", "ndjson"] = "csv", db=Depends(get_pool)):
+    """Import users from a CSV or NDJSON request body.
+
+    Returns counts plus a row for every duplicate or rejected line.
+    """
+    return await import_users(db, _request_lines(request), format)
+
+
+@router.get("/export", dependencies=[Depends(require_admin)])
+async def bulk_export(include_password_hashes: bool = False, db=Depends(get_pool)):
+    return StreamingResponse(
+        export_users(db, include_password_hashes),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=users.csv"},
+    )
+
+
+async def _file_lines(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            yield line.rstrip("\r\n")
+
+
+async def _main(args):
+    db = await open_pool()
+    try:
+        if args.command == "import":
+            report = await import_users(db, _file_lines(args.path), args.format)
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.path, "wb") as f:
+                async for chunk in export_users(db, args.include_password_hashes):
+                    f.write(chunk)
+    finally:
+        shutdown_executor()
+        await close_pool()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bulk_users")
+    sub = parser.add_subparsers(dest="command", required=True)
+    importer = sub.add_parser("import", help="load users from a CSV or NDJSON file")
+    importer.add_argument("path")
+    importer.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+    exporter = sub.add_parser("export", help="write all users to a CSV file")
+    exporter.add_argument("path")
+    exporter.add_argument("--include-password-hashes", action="store_true")
+    asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
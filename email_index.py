@@ -0,0 +1,223 @@
+"""In-memory existence filter over users.email.
+
+A Bloom filter loaded from the users table and topped up as accounts are
+created, so most "is this email taken?" checks for new addresses never reach
+the database. A miss is definite. A hit, or any check before the first load
+finishes, is confirmed with an indexed query.
+
+A trigger on users announces every new account on the users_created
+channel, whichever worker, import or script created it. Each worker
+listens and adds them. A miss is only trusted while that listener is
+connected and the filter was loaded after it started listening. Otherwise
+misses are confirmed in the database too. EMAIL_FILTER_NOTIFY=false skips
+the listener and trusts the filter regardless, which is only right for a
+single process.
+
+Bloom filters can't forget, so deleted emails stay as hits until the next
+reload. Every EMAIL_FILTER_REFRESH seconds the filter is rebuilt and
+resized, reading the table EMAIL_FILTER_PAGE_SIZE rows per checkout.
+"""
+import asyncio
+import hashlib
+import os
+
+import psycopg
+
+from breached_passwords import bloom_probes, filter_size
+from metrics import gauge, timed
+from model import queries
+from model.config import DATABASE_URL
+from model.database import DatabaseUnavailable
+from model.users import USERS_CREATED_CHANNEL
+
+EMAIL_FILTER_FP_RATE = float(os.getenv("EMAIL_FILTER_FP_RATE", "0.01"))
+EMAIL_FILTER_MIN_CAPACITY = int(os.getenv("EMAIL_FILTER_MIN_CAPACITY", "100000"))
+EMAIL_FILTER_REFRESH = float(os.getenv("EMAIL_FILTER_REFRESH", "600"))
+EMAIL_FILTER_PAGE_SIZE = int(os.getenv("EMAIL_FILTER_PAGE_SIZE", "10000"))
+EMAIL_FILTER_NOTIFY = os.getenv("EMAIL_FILTER_NOTIFY", "true").lower() == "true"
+
+_lookups = {"filtered": 0, "taken": 0, "free": 0}
+
+
+def _digest(email: str) -> bytes:
+    return hashlib.blake2b(email.strip().lower().encode("utf-8"), digest_size=16).digest()
+
+
+class EmailFilter:
+    def __init__(self, capacity: int, fp_rate: float = EMAIL_FILTER_FP_RATE):
+        self.capacity = capacity
+        self.num_bits, self.num_hashes = filter_size(capacity, fp_rate)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.entries = 0
+
+    def add(self, email: str):
+        for position in bloom_probes(_digest(email), self.num_bits, self.num_hashes):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.entries += 1
+
+    def might_contain(self, email: str) -> bool:
+        bits = self.bits
+        for position in bloom_probes(_digest(email), self.num_bits, self.num_hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+_filter = None
+# Emails added while a reload is reading the table, replayed into the new filter
+_added_during_load = None
+_loader = None
+_listener = None
+_reload = None
+# Bumped whenever notifications may have been missed; a filter is trusted
+# only if its load started while listening in the current epoch
+_epoch = 0
+_filter_epoch = -1
+_listening = False
+
+
+def add(email: str):
+    """Note a new account; safe to call for emails that already exist"""
+    if _filter is not None:
+        _filter.add(email)
+    if _added_during_load is not None:
+        _added_during_load.append(email)
+
+
+async def load(db):
+    """Rebuild the filter from the users table, sized for twice the current count"""
+    global _filter, _filter_epoch, _added_during_load
+    epoch = _epoch if _listening else -1
+    _added_during_load = []
+    try:
+        with timed("email_filter_load"):
+            async with db.connection() as conn:
+                cur = await conn.execute("SELECT count(*) FROM users")
+                (count,) = await cur.fetchone()
+            fresh = EmailFilter(max(2 * count, EMAIL_FILTER_MIN_CAPACITY))
+            # One short checkout per page instead of holding a connection for the scan
+            last_id = 0
+            while True:
+                async with db.connection() as conn:
+                    cur = await conn.execute(
+                        "SELECT id, email FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                        (last_id, EMAIL_FILTER_PAGE_SIZE),
+                    )
+                    rows = await cur.fetchall()
+                for last_id, email in rows:
+                    fresh.add(email)
+                if len(rows) < EMAIL_FILTER_PAGE_SIZE:
+                    break
+        for email in _added_during_load:
+            fresh.add(email)
+        _filter = fresh
+        _filter_epoch = epoch
+    finally:
+        _added_during_load = None
+
+
+def _trusted() -> bool:
+    if _filter is None:
+        return False
+    return not EMAIL_FILTER_NOTIFY or (_listening and _filter_epoch == _epoch)
+
+
+async def email_exists(db, email: str) -> bool:
+    if _trusted() and not _filter.might_contain(email):
+        _lookups["filtered"] += 1
+        return False
+
+    async with db.connection() as conn:
+        with timed("db_email_exists"):
+            exists = await queries.email_exists(conn, email)
+    _lookups["taken" if exists else "free"] += 1
+    return exists
+
+
+async def _refresh(db):
+    if EMAIL_FILTER_NOTIFY:
+        # A load started before the listener is in would not be trusted
+        await _reload.wait()
+    while True:
+        _reload.clear()
+        try:
+            await load(db)
+        except (psycopg.Error, DatabaseUnavailable, RuntimeError):
+            # Keep serving from the previous filter (or the database) and retry later
+            pass
+        try:
+            await asyncio.wait_for(_reload.wait(), EMAIL_FILTER_REFRESH)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _request_reload():
+    """Stop trusting the current filter until a reload started from here finishes"""
+    global _epoch
+    _epoch += 1
+    _reload.set()
+
+
+async def _listen():
+    global _listening
+    delay = 1
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True)
+            async with conn:
+                await conn.execute(f"LISTEN {USERS_CREATED_CHANNEL}")
+                _listening = True
+                # Accounts created while we weren't listening are only in the table
+                _request_reload()
+                delay = 1
+                async for notify in conn.notifies():
+                    if notify.payload:
+                        add(notify.payload)
+                    else:
+                        _request_reload()
+        except asyncio.CancelledError:
+            _listening = False
+            raise
+        except psycopg.Error:
+            _listening = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+async def _cancel(task):
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def start_loader(db):
+    """Load the filter in the background; lookups use the database until it's ready"""
+    global _loader, _listener, _reload
+    if _loader is None:
+        _reload = asyncio.Event()
+        if EMAIL_FILTER_NOTIFY:
+            _listener = asyncio.create_task(_listen())
+        _loader = asyncio.create_task(_refresh(db))
+
+
+async def stop_loader():
+    global _filter, _loader, _listener
+    await _cancel(_listener)
+    await _cancel(_loader)
+    _listener = _loader = None
+    _filter = None
+
+
+@gauge("email_filter", "Email existence filter: entries and capacity")
+def _filter_size():
+    if _filter is None:
+        return []
+    return [({"value": "entries"}, _filter.entries), ({"value": "capacity"}, _filter.capacity)]
+
+
+@gauge("email_exists_lookups", "Email existence checks by how they were answered")
+def _lookup_counts():
+    return [({"result": result}, count) for result, count in _lookups.items()]
@@ -0,0 +1,50 @@
+"""Worker pools for CPU-bound work that must stay off the event loop."""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class WorkerPool:
+    """A process pool, started on first use, that falls back to threads.
+
+    Threads are used when ``kind`` isn't "process", when the platform can't
+    start processes, and after a crashed worker breaks the process pool.
+    """
+
+    def __init__(self, kind: str, workers: int, thread_name_prefix: str):
+        self.kind = kind
+        self.workers = workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+
+    def _threads(self):
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.thread_name_prefix)
+
+    def start(self):
+        if self._executor is not None:
+            return self._executor
+
+        if self.kind == "process":
+            try:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                return self._executor
+            except (OSError, NotImplementedError, ImportError):
+                pass
+
+        self._executor = self._threads()
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.start(), fn, *args)
+        except BrokenProcessPool:
+            # A crashed worker poisons the whole process pool; retry on threads.
+            broken, self._executor = self._executor, self._threads()
+            broken.shutdown(wait=False, cancel_futures=True)
+            return await loop.run_in_executor(self._executor, fn, *args)
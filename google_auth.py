@@ -2,9 +2,18 @@ import os
 import jwt
 import datetime
 import httpx
-from fastapi import APIRouter, Request, HTTPException, status
+from fastapi import APIRouter, Depends, Request, HTTPException, status
 from fastapi.responses import RedirectResponse
-from model.config import conn
+from psycopg_pool import AsyncConnectionPool
+from google_client import GOOGLE_TOKEN_URL, get_http_client, verify_id_token
+from metrics import timed
+from model import queries
+from model.database import get_pool
+from rate_limit import client_ip
+import audit
+import email_index
+import profile_cache
+from sessions import start_session
 import urllib.parse
 import json
 
@@ -34,12 +43,13 @@ def create_access_token(data: dict, expires_delta: datetime.timedelta = None):
     else:
         expire = datetime.datetime.utcnow() + datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with timed("jwt_encode"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
 
-@router.get("/google/login")
+@router.get("/google/login", response_class=RedirectResponse)
 async def google_login(company_url: str):
     if company_url not in ALLOWED_COMPANY_URLS:
         raise HTTPException(status_code=400, detail="Invalid company URL")
@@ -64,90 +74,96 @@ async def google_login(company_url: str):
     return RedirectResponse(url=google_auth_url)
 
 
-@router.get("/auth/google/callback")
+@router.get("/auth/google/callback", response_class=RedirectResponse)
 async def google_callback(
+    request: Request,
     code: str | None = None,
     state: str | None = None,
-    error: str | None = None
+    error: str | None = None,
+    db: AsyncConnectionPool = Depends(get_pool),
+    http_client: httpx.AsyncClient = Depends(get_http_client),
 ):
+    ip = client_ip(request)
     if error:
+        audit.record("google_callback", "failure", ip=ip, detail=error)
         raise HTTPException(status_code=400, detail=error)
 
     if not code or not state:
+        audit.record("google_callback", "failure", ip=ip, detail="missing code or state")
         raise HTTPException(status_code=400, detail="Missing code or state")
 
     try:
         state_data = json.loads(urllib.parse.unquote(state))
         company_url = state_data["company_url"]
     except Exception:
+        audit.record("google_callback", "failure", ip=ip, detail="invalid state")
         raise HTTPException(status_code=400, detail="Invalid state")
 
     if company_url not in ALLOWED_COMPANY_URLS:
+        audit.record("google_callback", "failure", ip=ip, detail="unapproved client")
         raise HTTPException(status_code=400, detail="Unapproved client")
 
-    token_response = await httpx.AsyncClient().post(
-        "https://oauth2.googleapis.com/token",
-        data={
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "code": code,
-            "grant_type": "authorization_code",
-            "redirect_uri": GOOGLE_REDIRECT_URI,
-        },
-    )
-
-    token_json = token_response.json()
-
-
-    if "access_token" not in token_json:
+    try:
+        with timed("google_token_exchange"):
+            token_response = await http_client.post(
+                GOOGLE_TOKEN_URL,
+                data={
+                    "client_id": GOOGLE_CLIENT_ID,
+                    "client_secret": GOOGLE_CLIENT_SECRET,
+                    "code": code,
+                    "grant_type": "authorization_code",
+                    "redirect_uri": GOOGLE_REDIRECT_URI,
+                },
+            )
+        token_json = token_response.json()
+    except (httpx.HTTPError, ValueError):
+        audit.record("google_callback", "failure", ip=ip, detail="token exchange failed")
         return RedirectResponse(f"{company_url}/auth?error=token_exchange_failed")
 
-    access_token = token_json["access_token"]
+    if "id_token" not in token_json:
+        audit.record("google_callback", "failure", ip=ip, detail="token exchange failed")
+        return RedirectResponse(f"{company_url}/auth?error=token_exchange_failed")
 
-    user_response = await httpx.AsyncClient().get(
-        "https://www.googleapis.com/oauth2/v2/userinfo",
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
+    # The ID token already carries the profile, so verify it locally against
+    # Google's cached signing keys instead of calling the userinfo endpoint.
+    try:
+        with timed("google_id_token_verify"):
+            user_info = await verify_id_token(http_client, token_json["id_token"], GOOGLE_CLIENT_ID)
+    except (jwt.InvalidTokenError, httpx.HTTPError):
+        audit.record("google_callback", "failure", ip=ip, detail="invalid id token")
+        return RedirectResponse(f"{company_url}/auth?error=userinfo_failed")
 
-    user_info = user_response.json()
-    if "email" not in user_info:
+    if "email" not in user_info or user_info.get("email_verified") is False:
+        audit.record("google_callback", "failure", email=user_info.get("email"), ip=ip, detail="email not verified")
         return RedirectResponse(f"{company_url}/auth?error=userinfo_failed")
 
     email = user_info["email"]
     name = user_info.get("name", email.split("@")[0])
-    google_id = user_info.get("id")
+    google_id = user_info.get("sub")
     picture = user_info.get("picture")
 
-    with conn.cursor() as cur:
-        cur.execute("SELECT id FROM users WHERE email=%s", (email,))
-        user = cur.fetchone()
-
-        if user:
-            cur.execute(
-                """UPDATE users SET username=%s, google_id=%s, profile_picture=%s
-                   WHERE email=%s RETURNING id, username, email""",
-                (name, google_id, picture, email),
-            )
-        else:
-            cur.execute(
-                """INSERT INTO users (email, username, google_id, is_google_user, profile_picture)
-                   VALUES (%s, %s, %s, true, %s)
-                   RETURNING id, username, email""",
-                (email, name, google_id, picture),
-            )
-
-        user_record = cur.fetchone()
-        conn.commit()
+    async with db.connection() as conn:
+        with timed("db_google_upsert"):
+            user_record = await queries.upsert_google_user(conn, email, name, google_id, picture)
+            await conn.commit()
+    email_index.add(email)
+    if user_record.changed:
+        await profile_cache.invalidate(db, email)
+    audit.record("google_callback", "success", email=email, user_id=user_record.id, ip=ip)
 
+    session_id, refresh_token = await start_session(db, user_record.id, email)
     jwt_token = create_access_token({
         "sub": email,
+        "sid": session_id,
         "user": {
-            "id": user_record[0],
-            "username": user_record[1],
-            "email": user_record[2],
+            "id": user_record.id,
+            "username": user_record.username,
+            "email": user_record.email,
             "is_google_user": True,
             "profile_picture": picture,
         }
     })
 
-    return RedirectResponse(f"{company_url}/auth?token={jwt_token}")
+    # The long-lived refresh token goes in the fragment, which browsers never send
+    # to a server, so it stays out of access logs and Referer headers
+    return RedirectResponse(f"{company_url}/auth?token={jwt_token}#refresh_token={refresh_token}")
@@ -0,0 +1,116 @@
+import asyncio
+import re
+import time
+
+import httpx
+import jwt
+
+from metrics import timed
+
+GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ["https://accounts.google.com", "accounts.google.com"]
+
+# Used when Google's certs response has no usable Cache-Control max-age
+JWKS_DEFAULT_MAX_AGE = 3600
+# An unknown kid forces a refetch, but no more often than this
+JWKS_MIN_REFRESH_INTERVAL = 60
+
+http_client: httpx.AsyncClient | None = None
+
+
+def open_client(transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncClient:
+    """Create the app-lifetime client used for every call to Google.
+
+    ``transport`` lets tests and benchmarks swap in an ``httpx.MockTransport``.
+    """
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            http2=transport is None,
+            transport=transport,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=60,
+            ),
+        )
+    return http_client
+
+
+async def close_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+async def get_http_client() -> httpx.AsyncClient:
+    """FastAPI dependency returning the shared Google client"""
+    if http_client is None:
+        raise RuntimeError("Google HTTP client is not open")
+    return http_client
+
+
+def _max_age(cache_control: str | None) -> int:
+    match = re.search(r"max-age=(\d+)", cache_control or "")
+    return int(match.group(1)) if match else JWKS_DEFAULT_MAX_AGE
+
+
+class GoogleKeySet:
+    """Google's ID-token signing keys, cached for as long as Google says they are fresh"""
+
+    def __init__(self):
+        self._keys = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _refresh(self, client: httpx.AsyncClient):
+        with timed("google_jwks_fetch"):
+            response = await client.get(GOOGLE_CERTS_URL)
+        response.raise_for_status()
+        keyset = jwt.PyJWKSet.from_dict(response.json())
+        now = time.monotonic()
+        self._keys = {key.key_id: key for key in keyset.keys}
+        self._fetched_at = now
+        self._expires_at = now + _max_age(response.headers.get("cache-control"))
+
+    async def get_key(self, client: httpx.AsyncClient, kid: str) -> jwt.PyJWK:
+        now = time.monotonic()
+        if now < self._expires_at and kid in self._keys:
+            return self._keys[kid]
+
+        async with self._lock:
+            # Another request may have refreshed while we waited for the lock
+            now = time.monotonic()
+            stale = now >= self._expires_at
+            unknown_kid = kid not in self._keys
+            if stale or (unknown_kid and now - self._fetched_at >= JWKS_MIN_REFRESH_INTERVAL):
+                await self._refresh(client)
+
+        try:
+            return self._keys[kid]
+        except KeyError:
+            raise jwt.InvalidTokenError(f"Unknown signing key {kid!r}")
+
+
+google_keys = GoogleKeySet()
+
+
+async def verify_id_token(client: httpx.AsyncClient, id_token: str, audience: str) -> dict:
+    """Verify a Google ID token locally and return its claims.
+
+    Raises ``jwt.InvalidTokenError`` if the signature, audience, issuer or
+    expiry don't check out.
+    """
+    kid = jwt.get_unverified_header(id_token).get("kid")
+    key = await google_keys.get_key(client, kid)
+    return jwt.decode(
+        id_token,
+        key.key,
+        algorithms=["RS256"],
+        audience=audience,
+        issuer=GOOGLE_ISSUERS,
+    )
@@ -1,14 +1,53 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, APIRouter
+from fastapi.responses import ORJSONResponse
+import audit
+import breached_passwords
+import email_index
 import mfa_authenticator
 import user_controller
 import google_auth
-from model.config import conn
+import auth_tokens
+import bulk_users
+import google_client
+import metrics
+from model.database import open_pool, close_pool
 from fastapi.middleware.cors import CORSMiddleware
+import password_hashing
+import profile_cache
+import qr_codes
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    password_hashing.start_executor()
+    password_hashing.calibrate_cost()
+    qr_codes.start_executor()
+    breached_passwords.load_filter()
+    pool = await open_pool()
+    audit.start_writer()
+    email_index.start_loader(pool)
+    google_client.open_client()
+    profile_cache.start_listener()
+    yield
+    await profile_cache.stop_listener()
+    await google_client.close_client()
+    await email_index.stop_loader()
+    await audit.stop_writer()
+    await close_pool()
+    breached_passwords.close_filter()
+    qr_codes.shutdown_executor()
+    password_hashing.shutdown_executor()
+
+
+# orjson renders what the response models produce, datetimes included, in one native pass
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.include_router(mfa_authenticator.router)
 app.include_router(user_controller.router)
 app.include_router(google_auth.router)
+app.include_router(auth_tokens.router)
+app.include_router(metrics.router)
+app.include_router(bulk_users.router)
 
 
 origins = [
@@ -24,6 +63,7 @@ app.add_middleware(
     allow_methods=["*"],         
     allow_headers=["*"],         
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 if __name__ == "__main__":
     import uvicorn
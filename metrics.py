@@ -0,0 +1,154 @@
+import bisect
+import time
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+router = APIRouter(tags=["metrics"])
+
+# Seconds; covers dict lookups through bcrypt and slow Google round trips
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Series:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Prometheus-style histogram. Observing is a bisect and three increments."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        _histograms.append(self)
+
+    def observe(self, seconds, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = _Series(len(self.buckets) + 1)
+        series.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        series.total += seconds
+        series.count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _labels(self.label_names, label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {series.total}")
+            lines.append(f"{self.name}_count{labels} {series.count}")
+        return lines
+
+
+_histograms = []
+# name -> (help, callback returning [(label dict, value), ...])
+_gauges = {}
+
+
+def gauge(name, help):
+    """Register a callback whose values are read at scrape time"""
+
+    def register(fn):
+        _gauges[name] = (help, fn)
+        return fn
+
+    return register
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, by route template",
+    labels=("method", "route", "status"),
+)
+stage_seconds = Histogram(
+    "auth_stage_duration_seconds",
+    "Time spent in one stage of request handling",
+    labels=("stage",),
+)
+
+
+class timed:
+    """``with timed("bcrypt_check"): ...`` records the block under that stage"""
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_seconds.observe(time.perf_counter() - self.start, self.stage)
+
+
+class MetricsMiddleware:
+    """Records every HTTP request in http_request_duration_seconds"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # Route templates, not raw paths, so /user/{email} stays one series
+            path = getattr(route, "path", "unmatched")
+            request_seconds.observe(time.perf_counter() - start, scope["method"], path, status)
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for name, (help, fn) in _gauges.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in fn():
+            lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
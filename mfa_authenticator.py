@@ -1,124 +1,219 @@
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import pyotp
-import qrcode
-from io import BytesIO
 import base64
-from fastapi import APIRouter, HTTPException
-from psycopg2 import pool
-import os
-from dotenv import load_dotenv
-load_dotenv()
+import urllib.parse
+from typing import Literal
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from psycopg_pool import AsyncConnectionPool
 import datetime
 
+import audit
+from auth_tokens import current_user
+from metrics import timed
+import profile_cache
+from model import queries
+from model.database import get_pool
+from qr_codes import QR_MEDIA_TYPES, render_qr
+from rate_limit import client_ip, mfa_email_limiter
+from schemas import MFASetupResponse, MFAStatus, StatusMessage
+from totp_engine import totp_verifier
+
 router = APIRouter()
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-pg_pool = pool.SimpleConnectionPool(1, 10, DATABASE_URL)
 
-@router.post("/setup_mfa")
-def setup_mfa(email: str):
-    conn = None
+ISSUER_NAME = "MyAuthApp"
+
+
+def _provisioning_uri(secret, email):
+    return pyotp.TOTP(secret).provisioning_uri(name=email, issuer_name=ISSUER_NAME)
+
+
+@router.post("/setup_mfa", response_model=MFASetupResponse, response_model_exclude_unset=True)
+async def setup_mfa(
+    email: str,
+    qr_format: Literal["png", "svg", "url"] = "png",
+    db: AsyncConnectionPool = Depends(get_pool),
+):
+    """Start MFA enrollment.
+
+    The new secret is pending until a code for it is sent to /verify_mfa.
+
+    ``qr_format`` picks how the QR code comes back: a PNG data URI (default),
+    an SVG data URI, or ``url`` to skip inline rendering and fetch raw PNG
+    bytes from ``qr_code_url`` instead.
+    """
     try:
-        conn = pg_pool.getconn()
-        
         secret = pyotp.random_base32()
         
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, user_secret FROM users WHERE email = %s", (email,))
-            user = cur.fetchone()
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # if user[1] is not None:
-            #   raise HTTPException(status_code=409, detail="MFA is already setup")
-
-
-            cur.execute(
-                "UPDATE users SET user_secret = %s WHERE email = %s",
-                (secret, email)
-            )
-
-            cur.execute(
-                "UPDATE users SET mfa_enabled = True",
-            )
-            conn.commit()
+        # Only this user's row, and only the pending secret: MFA stays as it
+        # was until verify_mfa sees a valid code for the new secret
+        async with db.connection() as conn:
+            with timed("db_mfa_enroll"):
+                cur = await conn.execute(
+                    "UPDATE users SET pending_user_secret = %s WHERE email = %s RETURNING id",
+                    (secret, email)
+                )
+                user = await cur.fetchone()
+                await conn.commit()
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        totp_verifier.invalidate(email)
+        await profile_cache.invalidate(db, email)
         
-        issuer_name = "MyAuthApp"
-        uri = pyotp.TOTP(secret).provisioning_uri(
-            name=email, 
-            issuer_name=issuer_name
-        )
-        
-        qr = qrcode.make(uri)
-        buffer = BytesIO()
-        qr.save(buffer, format='PNG')
-        qr_base64 = base64.b64encode(buffer.getvalue()).decode()
-        
-        return {
+        uri = _provisioning_uri(secret, email)
+        response = {
             "status": "success",
-            "qr_code": f"data:image/png;base64,{qr_base64}",
+            "qr_code_url": f"/mfa_qr/{urllib.parse.quote(email)}",
             # "secret": secret,  
             "uri": uri
         }
+
+        # Rendered after the connection is back in the pool
+        if qr_format == "png":
+            qr_png = await render_qr(uri, "png")
+            response["qr_code"] = f"data:image/png;base64,{base64.b64encode(qr_png).decode()}"
+        elif qr_format == "svg":
+            qr_svg = await render_qr(uri, "svg")
+            response["qr_code"] = f"data:image/svg+xml;utf8,{urllib.parse.quote(qr_svg)}"
+
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
 
 
 
-@router.post("/verify_mfa")
-def verify_mfa(email: str, code: str):
-    conn = None
+@router.get("/mfa_qr/{email}", response_class=Response)
+async def get_mfa_qr(
+    email: str,
+    format: Literal["png", "svg"] = "png",
+    claims: dict = Depends(current_user),
+    db: AsyncConnectionPool = Depends(get_pool),
+):
+    """Raw QR image for the signed-in user's pending MFA secret.
+
+    Only while enrollment is pending: once a code confirms the secret it is
+    never shown again, so a leaked access token can't be used to copy it.
+    """
+    async with db.connection() as conn:
+        cur = await conn.execute(
+            "SELECT id, pending_user_secret FROM users WHERE email = %s",
+            (email,)
+        )
+        row = await cur.fetchone()
+
+    if not row or not row[1]:
+        raise HTTPException(status_code=404, detail="No pending MFA enrollment for this user")
+
+    # Password logins put the user id in "sub", Google logins the email
+    if claims.get("sub") not in (email, str(row[0])):
+        raise HTTPException(status_code=403, detail="Not allowed to view this QR code")
+
+    image = await render_qr(_provisioning_uri(row[1], email), format)
+    return Response(image, media_type=QR_MEDIA_TYPES[format], headers={"Cache-Control": "no-store"})
+
+
+async def _activate_pending_secret(db, email, secret, step):
+    async with db.connection() as conn:
+        with timed("db_mfa_activate"):
+            cur = await conn.execute(
+                """UPDATE users
+                   SET user_secret = pending_user_secret, pending_user_secret = NULL,
+                       mfa_enabled = TRUE, totp_last_step = %(step)s
+                   WHERE email = %(email)s AND pending_user_secret = %(secret)s
+                     AND (totp_last_step IS NULL OR totp_last_step < %(step)s)""",
+                {"email": email, "secret": secret, "step": step}
+            )
+            await conn.commit()
+    # Zero rows: setup_mfa issued another secret in the meantime, or another
+    # worker already accepted this code
+    return cur.rowcount == 1
+
+
+async def _claim_step(db, email, step):
+    async with db.connection() as conn:
+        with timed("db_totp_claim"):
+            claimed = await queries.claim_totp_step(conn, email, step)
+            await conn.commit()
+    return claimed
+
+
+@router.post("/verify_mfa", response_model=StatusMessage)
+async def verify_mfa(email: str, code: str, request: Request, db: AsyncConnectionPool = Depends(get_pool)):
+    """Verify a TOTP code; the first valid code for a pending secret activates it"""
+    ip = client_ip(request)
     try:
-        conn = pg_pool.getconn()
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_secret FROM users WHERE email = %s", (email,))
-            row = cur.fetchone()
-
-            if not row or not row[0]:
-                raise HTTPException(status_code=404, detail="MFA not set up for this user")
-
-            user_secret = row[0]
-            code = str(code).strip()
-            
-            totp = pyotp.TOTP(user_secret, digits=6, interval=30)
-            
-            is_valid = totp.verify(code, valid_window=1)
-
-            if is_valid:
-                return {
-                    "status": "success",
-                    "message": "Code verified successfully"
-                }
-            else:
-                raise HTTPException(status_code=401, detail="Invalid MFA code")
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
-
-
-@router.get("/mfa_status/{email}")
-def check_mfa_status(email: str):
+        mfa_email_limiter.check(email.strip().lower())
+    except HTTPException:
+        audit.record("mfa_verify", "blocked", email=email, ip=ip)
+        raise
+    activated = False
+    # Codes are checked in memory; only one that passes costs a database write,
+    # which claims its step for every worker
+    step = pending_step = None
+    if totp_verifier.has_secret(email):
+        with timed("totp_verify"):
+            step = totp_verifier.match(email, code)
+    else:
+        async with db.connection() as conn:
+            with timed("db_mfa_secret_lookup"):
+                row = await queries.fetch_mfa_secrets(conn, email)
+
+        if not row or not (row.user_secret or row.pending_user_secret):
+            audit.record("mfa_verify", "failure", email=email, ip=ip, detail="mfa not set up")
+            raise HTTPException(status_code=404, detail="MFA not set up for this user")
+
+        active_secret, pending_secret = row
+        # Replays are tracked per email, so a code can't be used once per secret
+        with timed("totp_verify"):
+            if active_secret:
+                totp_verifier.store_secret(email, active_secret)
+                step = totp_verifier.match(email, code)
+            if step is None and pending_secret:
+                totp_verifier.store_secret(email, pending_secret)
+                pending_step = totp_verifier.match(email, code)
+
+        if pending_step is not None:
+            activated = await _activate_pending_secret(db, email, pending_secret, pending_step)
+            await profile_cache.invalidate(db, email)
+
+        # Keep reading from the database while an enrollment is pending
+        if pending_secret and not activated:
+            totp_verifier.invalidate(email)
+
+    is_valid = activated or (step is not None and await _claim_step(db, email, step))
+    if is_valid:
+        audit.record("mfa_verify", "success", email=email, ip=ip, detail="enrolled" if activated else None)
+        return {
+            "status": "success",
+            "message": "Code verified successfully"
+        }
+    else:
+        audit.record("mfa_verify", "failure", email=email, ip=ip, detail="invalid code")
+        raise HTTPException(status_code=401, detail="Invalid MFA code")
+
+
+@router.get("/mfa_status/{email}", response_model=MFAStatus)
+async def check_mfa_status(
+    email: str,
+    response: Response,
+    if_none_match: str | None = Header(None),
+    db: AsyncConnectionPool = Depends(get_pool),
+):
     """Check if user has MFA enabled"""
-    conn = None
-    try:
-        conn = pg_pool.getconn()
-        
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_secret FROM users WHERE email = %s", (email,))
-            row = cur.fetchone()
-            
-            if not row:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            return {
-                "mfa_enabled": row[0] is not None,
-                "email": email
-            }
-                
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
\ No newline at end of file
+    profile = await profile_cache.get_profile(db, email)
+    
+    if profile is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    return profile_cache.cached_response(
+        {
+            "mfa_enabled": profile.mfa_enabled,
+            "email": email
+        },
+        profile.mfa_etag,
+        if_none_match,
+        response,
+    )
@@ -0,0 +1,19 @@
+async def create_audit_events(conn):
+    async with conn.cursor() as cur:
+        # Append-only; user_id has no foreign key so history survives account deletion
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.audit_events (
+    id BIGSERIAL PRIMARY KEY,
+    occurred_at TIMESTAMPTZ NOT NULL,
+    event TEXT NOT NULL,  -- login, mfa_verify, google_callback
+    outcome TEXT NOT NULL,  -- success, failure, ...
+    user_id INTEGER,
+    email TEXT,
+    ip TEXT,
+    detail TEXT
+            );
+        """)
+        await cur.execute(
+            "CREATE INDEX IF NOT EXISTS audit_events_email_idx ON public.audit_events (email, occurred_at)"
+        )
+    await conn.commit()
@@ -1,7 +1,23 @@
-import psycopg2
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
-conn = psycopg2.connect(DATABASE_URL)
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))
+# Requests allowed to queue for a connection; beyond this they get a 503 at once
+DB_MAX_WAITING = int(os.getenv("DB_MAX_WAITING", "50"))
+DB_MAX_LIFETIME = float(os.getenv("DB_MAX_LIFETIME", "3600"))
+DB_MAX_IDLE = float(os.getenv("DB_MAX_IDLE", "600"))
+# Idle connections are tested this often; DB_CHECK_ON_CHECKOUT tests every checkout too
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+DB_CHECK_ON_CHECKOUT = os.getenv("DB_CHECK_ON_CHECKOUT", "false").lower() == "true"
+# Consecutive timed-out checkouts, with none succeeding in between, before failing fast
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "3"))
+DB_BREAKER_COOLDOWN = float(os.getenv("DB_BREAKER_COOLDOWN", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "5"))
+# Apply pending migrations at startup instead of from a deploy step (python run.py)
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "false").lower() == "true"
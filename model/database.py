@@ -0,0 +1,229 @@
+import asyncio
+import math
+import time
+
+import psycopg
+from fastapi import HTTPException
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
+
+from metrics import gauge, stage_seconds
+from model.migrations import migrate
+from model.config import (
+    DATABASE_URL,
+    DB_ACQUIRE_TIMEOUT,
+    DB_AUTO_MIGRATE,
+    DB_BREAKER_COOLDOWN,
+    DB_BREAKER_THRESHOLD,
+    DB_CHECK_ON_CHECKOUT,
+    DB_HEALTH_CHECK_INTERVAL,
+    DB_MAX_IDLE,
+    DB_MAX_LIFETIME,
+    DB_MAX_WAITING,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MIN_SIZE,
+    DB_PREPARE_THRESHOLD,
+    DB_STATEMENT_CACHE_SIZE,
+)
+
+
+class DatabaseUnavailable(HTTPException):
+    """503 raised instead of queueing a request the pool can't serve in time.
+
+    An HTTPException, so the handlers' ``except HTTPException: raise`` passes
+    it through rather than turning it into a 200 ``{"status": "error"}``.
+    """
+
+    def __init__(self, detail: str, retry_after: float = 1):
+        super().__init__(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+class CircuitBreaker:
+    """Fails checkouts fast once Postgres looks unreachable.
+
+    Opens after ``threshold`` consecutive failed checkouts with none
+    succeeding in between. After ``cooldown`` seconds it lets a single trial
+    checkout through: success closes it, any other outcome opens it again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+
+    def retry_after(self) -> float:
+        return self.opened_at + self.cooldown - time.monotonic()
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN)
+# reason -> requests answered with a 503 instead of a connection
+_shed = {"queue_full": 0, "timeout": 0, "circuit_open": 0}
+
+
+class InstrumentedPool(AsyncConnectionPool):
+    """Admission control in front of every checkout, including via ``connection()``.
+
+    Records how long each checkout waited. When the wait queue is full, the
+    acquire deadline passes, or the circuit breaker is open, the checkout
+    raises DatabaseUnavailable instead.
+    """
+
+    async def getconn(self, timeout=None):
+        if not breaker.allow():
+            _shed["circuit_open"] += 1
+            raise DatabaseUnavailable("Database unavailable", breaker.retry_after())
+
+        trial = breaker.state == breaker.HALF_OPEN
+        start = time.perf_counter()
+        try:
+            try:
+                conn = await super().getconn(timeout)
+            except TooManyRequests:
+                _shed["queue_full"] += 1
+                raise DatabaseUnavailable("Server busy, try again shortly")
+            except PoolTimeout:
+                _shed["timeout"] += 1
+                # Any checkout that succeeds resets the count, so under plain overload
+                # timeouts rarely run together. pool_size is no guide: the pool keeps
+                # counting connections it is still trying to reconnect.
+                breaker.record_failure()
+                raise DatabaseUnavailable("Server busy, try again shortly")
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, "db_acquire")
+        except BaseException:
+            # However the trial ended (cancelled, pool closed, queue full), settle
+            # it, or every later checkout would be refused
+            if trial and breaker.state == breaker.HALF_OPEN:
+                breaker.record_failure()
+            raise
+        breaker.record_success()
+        return conn
+
+
+pg_pool: InstrumentedPool | None = None
+_health_task = None
+
+
+async def _configure(conn):
+    # Statements run more than DB_PREPARE_THRESHOLD times are prepared server-side
+    # and kept in a per-connection LRU of this size.
+    conn.prepared_max = DB_STATEMENT_CACHE_SIZE
+
+
+async def _health_check():
+    """Test idle connections now and then; broken ones are replaced in the background"""
+    while True:
+        await asyncio.sleep(DB_HEALTH_CHECK_INTERVAL)
+        try:
+            await pg_pool.check()
+        except psycopg.Error:
+            pass
+
+
+async def open_pool():
+    """Create the app-wide connection pool. Called once from the FastAPI lifespan."""
+    global pg_pool, _health_task
+    if pg_pool is None:
+        pg_pool = InstrumentedPool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_ACQUIRE_TIMEOUT,
+            max_waiting=DB_MAX_WAITING,
+            max_lifetime=DB_MAX_LIFETIME,
+            max_idle=DB_MAX_IDLE,
+            check=AsyncConnectionPool.check_connection if DB_CHECK_ON_CHECKOUT else None,
+            kwargs={"prepare_threshold": DB_PREPARE_THRESHOLD},
+            configure=_configure,
+            open=False,
+        )
+        await pg_pool.open()
+        if DB_AUTO_MIGRATE:
+            async with pg_pool.connection() as conn:
+                await migrate(conn)
+        _health_task = asyncio.create_task(_health_check())
+    return pg_pool
+
+
+async def close_pool():
+    global pg_pool, _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        try:
+            await _health_task
+        except asyncio.CancelledError:
+            pass
+        _health_task = None
+    if pg_pool is not None:
+        await pg_pool.close()
+        pg_pool = None
+
+
+async def get_pool() -> AsyncConnectionPool:
+    """FastAPI dependency returning the shared pool.
+
+    Async, like every dependency here, so FastAPI calls it on the event loop
+    rather than sending it through the shared threadpool. Handlers check out
+    a connection with ``async with pool.connection()`` for only as long as
+    they need it, rather than for the whole request.
+    """
+    if pg_pool is None:
+        raise RuntimeError("Database pool is not open")
+    return pg_pool
+
+
+@gauge("db_pool_connections", "Connections in the pool, by state")
+def _pool_connections():
+    if pg_pool is None:
+        return []
+    stats = pg_pool.get_stats()
+    size = stats.get("pool_size", 0)
+    available = stats.get("pool_available", 0)
+    return [
+        ({"state": "max"}, stats.get("pool_max", 0)),
+        ({"state": "open"}, size),
+        ({"state": "idle"}, available),
+        ({"state": "in_use"}, size - available),
+    ]
+
+
+@gauge("db_pool_requests_waiting", "Requests queued for a pool connection")
+def _pool_waiting():
+    if pg_pool is None:
+        return []
+    return [({}, pg_pool.get_stats().get("requests_waiting", 0))]
+
+
+@gauge("db_circuit_breaker_state", "Database circuit breaker: 0 closed, 1 half-open, 2 open")
+def _breaker_state():
+    return [({}, breaker.state)]
+
+
+@gauge("db_requests_shed", "Checkouts answered with a 503, by reason")
+def _requests_shed():
+    return [({"reason": reason}, count) for reason, count in _shed.items()]
@@ -0,0 +1,96 @@
+"""Versioned schema migrations.
+
+Applied once per database, from a deploy step (``python run.py``) or, with
+DB_AUTO_MIGRATE=true, by whichever worker starts first. An advisory lock
+serialises concurrent runs and ``schema_migrations`` records what has been
+applied, so every other worker's check is a single query.
+"""
+import asyncio
+
+from model.audit import create_audit_events
+from model.sessions import create_sessions
+from model.users import (
+    add_lookup_indexes,
+    add_pending_mfa_secret,
+    add_totp_last_step,
+    add_users_created_notify,
+    create_users,
+    drop_lower_email_index,
+)
+
+# Arbitrary key for pg_advisory_lock; only needs to be stable
+MIGRATION_LOCK_ID = 7305_2201
+MIGRATION_LOCK_POLL = 0.5
+
+# (version, description, coroutine taking a connection). Never edit or
+# reorder applied entries; append new ones.
+MIGRATIONS = [
+    (1, "create users table", create_users),
+    (2, "create sessions table", create_sessions),
+    (3, "add pending MFA secret", add_pending_mfa_secret),
+    (4, "create audit events table", create_audit_events),
+    (5, "add google_id and lower(email) indexes", add_lookup_indexes),
+    (6, "add last accepted TOTP step", add_totp_last_step),
+    (7, "notify on new users", add_users_created_notify),
+    (8, "drop lower(email) index", drop_lower_email_index),
+]
+
+
+async def applied_versions(conn):
+    cur = await conn.execute("SELECT to_regclass('public.schema_migrations') IS NOT NULL")
+    if not (await cur.fetchone())[0]:
+        return set()
+    cur = await conn.execute("SELECT version FROM schema_migrations")
+    return {version for (version,) in await cur.fetchall()}
+
+
+async def pending_migrations(conn):
+    applied = await applied_versions(conn)
+    await conn.rollback()
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+async def _acquire_lock(conn):
+    # Polled rather than a blocking pg_advisory_lock: a waiter blocked in that
+    # call holds a snapshot, and CREATE INDEX CONCURRENTLY in the migration
+    # holding the lock would wait for that snapshot forever
+    while True:
+        cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        (locked,) = await cur.fetchone()
+        await conn.commit()
+        if locked:
+            return
+        await asyncio.sleep(MIGRATION_LOCK_POLL)
+
+
+async def migrate(conn):
+    """Apply every pending migration and return the versions applied"""
+    if not await pending_migrations(conn):
+        return []
+
+    await _acquire_lock(conn)
+    try:
+        await conn.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                   version INTEGER PRIMARY KEY,
+                   description TEXT NOT NULL,
+                   applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               )"""
+        )
+        await conn.commit()
+
+        # Re-read under the lock; another process may have just finished
+        done = []
+        for version, description, apply in await pending_migrations(conn):
+            await apply(conn)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description),
+            )
+            await conn.commit()
+            done.append(version)
+        return done
+    finally:
+        await conn.rollback()
+        await conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        await conn.commit()
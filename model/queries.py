@@ -0,0 +1,83 @@
+"""Named statements for the hot paths.
+
+Each query selects only the columns its caller reads and runs with
+``prepare=True``. That makes Postgres plan it once per connection, keeping
+the plan in the connection's prepared-statement LRU (DB_STATEMENT_CACHE_SIZE),
+rather than after DB_PREPARE_THRESHOLD executions. Rows come back as named
+tuples, so callers read ``row.password`` instead of ``row[3]``.
+
+The functions take a connection and leave transactions to the caller.
+"""
+from psycopg.rows import dict_row, namedtuple_row
+
+from model.users import USER_COLUMNS
+
+LOGIN_LOOKUP = "SELECT id, password, is_google_user FROM users WHERE email = %s"
+MFA_SECRETS = "SELECT user_secret, pending_user_secret FROM users WHERE email = %s"
+PROFILE_READ = (
+    f"SELECT {USER_COLUMNS}, user_secret IS NOT NULL AS has_mfa_secret FROM users WHERE email = %s"
+)
+# Exact match, like the UNIQUE(email) index that serves it and every other lookup
+EMAIL_EXISTS = "SELECT 1 FROM users WHERE email = %s"
+# Compare-and-set, so of two workers accepting the same code only one succeeds
+CLAIM_TOTP_STEP = """UPDATE users SET totp_last_step = %(step)s
+    WHERE email = %(email)s AND (totp_last_step IS NULL OR totp_last_step < %(step)s)
+    RETURNING id"""
+# The WHERE skips the write (and the row version) when Google sent nothing new;
+# the row then comes from the second branch instead of RETURNING
+GOOGLE_USER_UPSERT = """WITH written AS (
+        INSERT INTO users (email, username, google_id, is_google_user, profile_picture)
+        VALUES (%(email)s, %(name)s, %(google_id)s, true, %(picture)s)
+        ON CONFLICT (email) DO UPDATE
+            SET username = EXCLUDED.username,
+                google_id = EXCLUDED.google_id,
+                profile_picture = EXCLUDED.profile_picture
+            WHERE (users.username, users.google_id, users.profile_picture)
+                IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.google_id, EXCLUDED.profile_picture)
+        RETURNING id, username, email
+    )
+    SELECT id, username, email, true AS changed FROM written
+    UNION ALL
+    SELECT id, username, email, false FROM users
+    WHERE email = %(email)s AND NOT EXISTS (SELECT 1 FROM written)"""
+
+
+async def _fetchone(conn, query, params, row_factory=namedtuple_row):
+    async with conn.cursor(row_factory=row_factory) as cur:
+        await cur.execute(query, params, prepare=True)
+        return await cur.fetchone()
+
+
+async def fetch_login(conn, email: str):
+    """(id, password, is_google_user) for a password check, or None"""
+    return await _fetchone(conn, LOGIN_LOOKUP, (email,))
+
+
+async def fetch_mfa_secrets(conn, email: str):
+    """(user_secret, pending_user_secret), or None"""
+    return await _fetchone(conn, MFA_SECRETS, (email,))
+
+
+async def fetch_profile(conn, email: str):
+    """USER_COLUMNS plus has_mfa_secret as a dict, or None"""
+    return await _fetchone(conn, PROFILE_READ, (email,), row_factory=dict_row)
+
+
+async def email_exists(conn, email: str) -> bool:
+    return await _fetchone(conn, EMAIL_EXISTS, (email,)) is not None
+
+
+async def claim_totp_step(conn, email: str, step: int) -> bool:
+    """Record ``step`` as the user's last accepted TOTP step; False if it or a later one was used"""
+    return await _fetchone(conn, CLAIM_TOTP_STEP, {"email": email, "step": step}) is not None
+
+
+async def upsert_google_user(conn, email: str, name: str, google_id: str, picture: str | None):
+    """Create or refresh a Google account in one statement; returns (id, username, email, changed)"""
+    params = {"email": email, "name": name, "google_id": google_id, "picture": picture}
+    row = await _fetchone(conn, GOOGLE_USER_UPSERT, params)
+    if row is None:
+        # An identical row committed by a concurrent callback after this statement's
+        # snapshot: the conflict sees it but the fallback SELECT can't. A new statement can.
+        row = await _fetchone(conn, GOOGLE_USER_UPSERT, params)
+    return row
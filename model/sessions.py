@@ -0,0 +1,20 @@
+async def create_sessions(conn):
+    async with conn.cursor() as cur:
+        # One row per refresh token. Rotating a token marks its row and adds
+        # a new one in the same family, so a rotated token coming back is reuse.
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.sessions (
+    token_hash BYTEA PRIMARY KEY,  -- sha256 of the opaque refresh token
+    family UUID NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    subject TEXT NOT NULL,  -- "sub" for access tokens minted from this session
+    expires_at TIMESTAMPTZ NOT NULL,
+    rotated_at TIMESTAMPTZ,
+    revoked_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        await cur.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_family_idx ON public.sessions (family)"
+        )
+    await conn.commit()
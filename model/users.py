@@ -1,6 +1,14 @@
-def create_users(conn):
-    with conn.cursor() as cur:
-        cur.execute("""
+# Public profile columns; never select password hashes or TOTP secrets for reads
+USER_COLUMNS = "id, email, username, profile_picture, is_google_user, mfa_enabled, created_at"
+# NOTIFY channel carrying the email of every new account; an empty payload
+# means too many to list, reload
+USERS_CREATED_CHANNEL = "users_created"
+USERS_CREATED_MAX_NOTIFY = 1000
+
+
+async def create_users(conn):
+    async with conn.cursor() as cur:
+        await cur.execute("""
            CREATE TABLE IF NOT EXISTS public.users (
     id SERIAL PRIMARY KEY,
     username TEXT,
@@ -17,7 +25,92 @@ def create_users(conn):
 #         cur.execute("""
 # ALTER TABLE users ALTER COLUMN username DROP NOT NULL;
 # """)
-    conn.commit()
+    await conn.commit()
+
+
+
+
+
+async def add_pending_mfa_secret(conn):
+    async with conn.cursor() as cur:
+        # setup_mfa parks the new secret here until verify_mfa sees a valid code
+        await cur.execute(
+            "ALTER TABLE public.users ADD COLUMN IF NOT EXISTS pending_user_secret TEXT"
+        )
+        # Earlier setup_mfa calls set mfa_enabled on every row; only users
+        # with a secret actually have MFA
+        await cur.execute(
+            """UPDATE public.users SET mfa_enabled = (user_secret IS NOT NULL)
+               WHERE mfa_enabled IS DISTINCT FROM (user_secret IS NOT NULL)"""
+        )
+    await conn.commit()
+
 
+LOOKUP_INDEXES = [
+    ("users_google_id_idx", "public.users (google_id) WHERE google_id IS NOT NULL"),
+    ("users_lower_email_idx", "public.users (lower(email))"),
+]
+
+
+async def add_lookup_indexes(conn):
+    # CONCURRENTLY so signups and logins keep writing while the indexes build;
+    # that can't run inside a transaction block
+    await conn.commit()
+    await conn.set_autocommit(True)
+    try:
+        for name, definition in LOOKUP_INDEXES:
+            # A build that failed or was interrupted leaves an INVALID index
+            # behind, which IF NOT EXISTS would otherwise accept
+            cur = await conn.execute(
+                "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                (f"public.{name}",),
+            )
+            row = await cur.fetchone()
+            if row and row[0]:
+                await conn.execute(f"DROP INDEX CONCURRENTLY public.{name}")
+            await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+    finally:
+        await conn.set_autocommit(False)
+
+
+async def add_totp_last_step(conn):
+    async with conn.cursor() as cur:
+        # The last TOTP time step accepted for the user, shared by every worker
+        # so a code replayed against another worker is still rejected
+        await cur.execute("ALTER TABLE public.users ADD COLUMN IF NOT EXISTS totp_last_step BIGINT")
+    await conn.commit()
+
+
+async def add_users_created_notify(conn):
+    # A trigger rather than the application, so other workers, bulk imports
+    # and anything else that inserts users are all announced
+    async with conn.cursor() as cur:
+        await cur.execute(f"""
+            CREATE OR REPLACE FUNCTION public.notify_users_created() RETURNS trigger AS $$
+            BEGIN
+                IF (SELECT count(*) FROM created) > {USERS_CREATED_MAX_NOTIFY} THEN
+                    PERFORM pg_notify('{USERS_CREATED_CHANNEL}', '');
+                ELSE
+                    PERFORM pg_notify('{USERS_CREATED_CHANNEL}', email) FROM created;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        await cur.execute("DROP TRIGGER IF EXISTS users_created_notify ON public.users")
+        await cur.execute(
+            """CREATE TRIGGER users_created_notify AFTER INSERT ON public.users
+               REFERENCING NEW TABLE AS created
+               FOR EACH STATEMENT EXECUTE FUNCTION public.notify_users_created()"""
+        )
+    await conn.commit()
 
 
+async def drop_lower_email_index(conn):
+    # Emails are matched exactly everywhere, so nothing reads this index
+    await conn.commit()
+    await conn.set_autocommit(True)
+    try:
+        await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS public.users_lower_email_idx")
+    finally:
+        await conn.set_autocommit(False)
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import time
+
+import bcrypt
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from executors import WorkerPool
+from metrics import gauge, timed
+
+load_dotenv()
+
+# bcrypt is CPU bound (~250 ms at cost 12), so it runs in its own executor
+# instead of Starlette's shared threadpool.
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "process")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE_DEPTH = int(os.getenv("PASSWORD_HASH_QUEUE_DEPTH", "64"))
+
+# The bcrypt cost is calibrated at startup to the highest value whose hash
+# fits in PASSWORD_HASH_TARGET_MS here, but never below PASSWORD_HASH_MIN_COST,
+# which defaults to the cost existing hashes were made with. Set
+# PASSWORD_HASH_COST to pin it, e.g. so every host in a mixed fleet agrees.
+DEFAULT_COST = 12
+PASSWORD_HASH_COST = int(os.getenv("PASSWORD_HASH_COST", "0"))
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", "250"))
+PASSWORD_HASH_MIN_COST = int(os.getenv("PASSWORD_HASH_MIN_COST", str(DEFAULT_COST)))
+PASSWORD_HASH_MAX_COST = int(os.getenv("PASSWORD_HASH_MAX_COST", "16"))
+CALIBRATION_PROBE_COST = 8
+
+_pool = WorkerPool(PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, "password-hash")
+_in_flight = 0
+_cost = None
+
+
+def _hash(password: bytes, rounds: int = DEFAULT_COST) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+def calibrate_cost() -> int:
+    """Pick the bcrypt cost for this process; each step up doubles the work"""
+    global _cost
+    if PASSWORD_HASH_COST:
+        _cost = PASSWORD_HASH_COST
+        return _cost
+
+    elapsed = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        _hash(b"calibration", CALIBRATION_PROBE_COST)
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    cost = CALIBRATION_PROBE_COST
+    budget = PASSWORD_HASH_TARGET_MS / 1000
+    while cost < PASSWORD_HASH_MAX_COST and elapsed * 2 <= budget:
+        elapsed *= 2
+        cost += 1
+    _cost = max(cost, PASSWORD_HASH_MIN_COST)
+    return _cost
+
+
+def current_cost() -> int:
+    return _cost if _cost is not None else calibrate_cost()
+
+
+def encode_stored_hash(hashed_password: bytes) -> str:
+    """Text stored in users.password: the bcrypt string itself, "$2b$<cost>$..." """
+    return hashed_password.decode("ascii")
+
+
+def decode_stored_hash(stored_hash_value) -> bytes:
+    """Accepts the canonical format and the legacy "\\x<hex>" text psycopg2 wrote for bytes"""
+    if hasattr(stored_hash_value, "tobytes"):
+        return stored_hash_value.tobytes()
+    if stored_hash_value.startswith("\\x"):
+        return bytes.fromhex(stored_hash_value[2:])
+    return stored_hash_value.encode("ascii")
+
+
+def needs_rehash(stored_hash_value) -> bool:
+    """True for legacy-format hashes and ones weaker than our current cost.
+
+    Stronger hashes are kept: rewriting them would weaken them, and workers
+    that calibrated to different costs would rehash the same accounts back
+    and forth.
+    """
+    if not isinstance(stored_hash_value, str) or stored_hash_value.startswith("\\x"):
+        return True
+    try:
+        return int(stored_hash_value.split("$")[2]) < current_cost()
+    except (IndexError, ValueError):
+        return True
+
+
+def start_executor():
+    """Create the hashing pool, falling back to threads if processes are unavailable"""
+    return _pool.start()
+
+
+def shutdown_executor():
+    _pool.shutdown()
+
+
+async def _run(stage, fn, *args):
+    global _in_flight
+    if _in_flight >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_DEPTH:
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    _in_flight += 1
+    try:
+        with timed(stage):
+            return await _pool.run(fn, *args)
+    finally:
+        _in_flight -= 1
+
+
+async def hash_password(password: str) -> bytes:
+    """Hash a password without blocking the event loop"""
+    return await _run("bcrypt_hash", _hash, password.encode("utf-8"), current_cost())
+
+
+async def hash_passwords(passwords: list[str]) -> list[bytes]:
+    """Hash a batch of passwords in order, for bulk imports.
+
+    Runs at most PASSWORD_HASH_WORKERS hashes at a time, so the rest of the
+    queue stays free for logins. Each hash is admitted like hash_password's,
+    so the batch gets the same 503 when the queue is full.
+    """
+    rounds = current_cost()
+    hashes = [None] * len(passwords)
+    pending = iter(enumerate(passwords))
+
+    async def worker():
+        for index, password in pending:
+            hashes[index] = await _run("bcrypt_hash", _hash, password.encode("utf-8"), rounds)
+
+    workers = [
+        asyncio.ensure_future(worker()) for _ in range(min(PASSWORD_HASH_WORKERS, len(passwords)))
+    ]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        raise
+    return hashes
+
+
+async def check_password(password: str, hashed: bytes) -> bool:
+    """Check a password against a bcrypt hash without blocking the event loop"""
+    return await _run("bcrypt_check", _check, password.encode("utf-8"), hashed)
+
+
+@gauge("password_hash_in_flight", "Password hash/check calls running or queued")
+def _hash_in_flight():
+    return [({}, _in_flight)]
+
+
+@gauge("password_hash_cost", "bcrypt cost used for new hashes")
+def _hash_cost():
+    return [({}, current_cost())]
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import psycopg
+from fastapi import Response
+
+from metrics import timed
+from model import queries
+from model.config import DATABASE_URL
+from totp_engine import totp_verifier
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))
+# Share invalidations between workers through Postgres LISTEN/NOTIFY
+PROFILE_CACHE_NOTIFY = os.getenv("PROFILE_CACHE_NOTIFY", "false").lower() == "true"
+NOTIFY_CHANNEL = "profile_cache"
+
+
+def _key(email: str) -> str:
+    return email.strip().lower()
+
+
+def etag_for(payload) -> str:
+    body = json.dumps(payload, sort_keys=True, default=str).encode()
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def not_modified(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def cached_response(payload, etag: str, if_none_match: str | None, response: Response):
+    """A bare 304 when the client already has this ETag, otherwise the payload"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if not_modified(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return payload
+
+
+class Profile:
+    __slots__ = ("user", "mfa_enabled", "expires_at", "_user_etag", "_mfa_etag")
+
+    def __init__(self, user: dict, mfa_enabled: bool, expires_at: float):
+        self.user = user
+        self.mfa_enabled = mfa_enabled
+        self.expires_at = expires_at
+        self._user_etag = None
+        self._mfa_etag = None
+
+    @property
+    def user_etag(self):
+        if self._user_etag is None:
+            self._user_etag = etag_for(self.user)
+        return self._user_etag
+
+    @property
+    def mfa_etag(self):
+        if self._mfa_etag is None:
+            self._mfa_etag = etag_for({"email": self.user["email"], "mfa_enabled": self.mfa_enabled})
+        return self._mfa_etag
+
+
+class ProfileCache:
+    """TTL + LRU cache of profile and MFA state, keyed by lower-cased email.
+
+    Emails are stored case-sensitively in users, so a hit must also match
+    the requested email exactly; the lower-cased key just makes
+    invalidation cover every spelling.
+    """
+
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, email: str) -> Profile | None:
+        key = _key(email)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic() or entry.user["email"] != email:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, user: dict, mfa_enabled: bool) -> Profile:
+        entry = Profile(user, mfa_enabled, time.monotonic() + self.ttl)
+        key = _key(user["email"])
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def discard(self, email: str):
+        self._entries.pop(_key(email), None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+profile_cache = ProfileCache()
+
+
+async def get_profile(db, email: str) -> Profile | None:
+    """Read-through lookup backing /user/{email} and /mfa_status/{email}"""
+    entry = profile_cache.get(email)
+    if entry is not None:
+        return entry
+
+    async with db.connection() as conn:
+        with timed("db_profile_lookup"):
+            row = await queries.fetch_profile(conn, email)
+
+    if row is None:
+        return None
+    has_mfa_secret = row.pop("has_mfa_secret")
+    return profile_cache.put(row, has_mfa_secret)
+
+
+async def invalidate(db, email: str):
+    """Drop a user's cached profile here and, if enabled, in every other worker"""
+    profile_cache.discard(email)
+    if PROFILE_CACHE_NOTIFY:
+        async with db.connection() as conn:
+            await conn.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, email))
+            await conn.commit()
+
+
+def _on_notify(email: str):
+    profile_cache.discard(email)
+    totp_verifier.invalidate(email)
+
+
+async def _listen():
+    delay = 1
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True)
+            async with conn:
+                await conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                # Anything could have changed while we weren't listening
+                profile_cache.clear()
+                delay = 1
+                async for notify in conn.notifies():
+                    _on_notify(notify.payload)
+        except asyncio.CancelledError:
+            raise
+        except psycopg.Error:
+            profile_cache.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+_listener = None
+
+
+def start_listener():
+    global _listener
+    if PROFILE_CACHE_NOTIFY and _listener is None:
+        _listener = asyncio.create_task(_listen())
+
+
+async def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        try:
+            await _listener
+        except asyncio.CancelledError:
+            pass
+        _listener = None
@@ -0,0 +1,102 @@
+import os
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from executors import WorkerPool
+from metrics import timed
+
+# Building the QR matrix is pure Python and PNG encoding goes through PIL, so
+# rendering happens in its own small pool rather than on the event loop.
+# qrcode (and PIL with it) is imported inside the renderers, so only the
+# render workers ever load them.
+QR_RENDER_EXECUTOR = os.getenv("QR_RENDER_EXECUTOR", "process")
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+QR_CACHE_TTL = int(os.getenv("QR_CACHE_TTL", "300"))
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "1024"))
+
+QR_MEDIA_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+
+_pool = WorkerPool(QR_RENDER_EXECUTOR, QR_RENDER_WORKERS, "qr-render")
+# (provisioning uri, format) -> (expires_at, rendered bytes)
+_cache = OrderedDict()
+
+
+def _render_png(uri: str) -> bytes:
+    import qrcode
+
+    buffer = BytesIO()
+    qrcode.make(uri).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _render_svg(uri: str) -> bytes:
+    """Render one path of horizontal runs; no PIL and far fewer nodes than qrcode's SVG factories"""
+    import qrcode
+
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(uri)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    size = len(matrix)
+
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                runs.append(f"M{start},{y}h{x - start}v1H{start}z")
+            else:
+                x += 1
+
+    return (
+        f"<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 {size} {size}' "
+        f"shape-rendering='crispEdges'><path fill='#fff' d='M0,0h{size}v{size}H0z'/>"
+        f"<path d='{''.join(runs)}'/></svg>"
+    ).encode()
+
+
+_RENDERERS = {
+    "png": _render_png,
+    "svg": _render_svg,
+}
+
+
+def _render(uri: str, fmt: str) -> bytes:
+    return _RENDERERS[fmt](uri)
+
+
+def start_executor():
+    return _pool.start()
+
+
+def shutdown_executor():
+    _pool.shutdown()
+
+
+async def render_qr(uri: str, fmt: str = "png") -> bytes:
+    """Render a provisioning URI as PNG or SVG bytes.
+
+    Results are cached for QR_CACHE_TTL seconds so client retries reuse them.
+    """
+    key = (uri, fmt)
+    now = time.monotonic()
+    cached = _cache.get(key)
+    if cached is not None and cached[0] > now:
+        _cache.move_to_end(key)
+        return cached[1]
+
+    with timed("qr_render"):
+        image = await _pool.run(_render, uri, fmt)
+
+    _cache[key] = (now + QR_CACHE_TTL, image)
+    _cache.move_to_end(key)
+    while len(_cache) > QR_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return image
@@ -0,0 +1,217 @@
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from fastapi import HTTPException, Request
+
+RATE_LIMIT_SHARDS = 16
+LOGIN_RATE_LIMIT_IP = os.getenv("LOGIN_RATE_LIMIT_IP", "20/minute")
+LOGIN_RATE_LIMIT_EMAIL = os.getenv("LOGIN_RATE_LIMIT_EMAIL", "5/minute")
+SIGNUP_RATE_LIMIT_IP = os.getenv("SIGNUP_RATE_LIMIT_IP", "10/minute")
+MFA_RATE_LIMIT_EMAIL = os.getenv("MFA_RATE_LIMIT_EMAIL", "5/minute")
+
+# Failed logins allowed before the account is locked, then the lock doubles
+# from LOGIN_LOCKOUT_BASE seconds up to LOGIN_LOCKOUT_MAX
+LOGIN_LOCKOUT_THRESHOLD = int(os.getenv("LOGIN_LOCKOUT_THRESHOLD", "5"))
+LOGIN_LOCKOUT_BASE = float(os.getenv("LOGIN_LOCKOUT_BASE", "1"))
+LOGIN_LOCKOUT_MAX = float(os.getenv("LOGIN_LOCKOUT_MAX", "900"))
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_limit(limit: str):
+    """Parse "5/minute" style limits into (count, window seconds)"""
+    count, period = limit.split("/")
+    return int(count), _PERIODS[period.strip().rstrip("s")]
+
+
+class RateLimitBackend(ABC):
+    """Where counters live. Swap in a shared implementation for multi-worker deployments.
+
+    ``hit`` returns 0 when the request is allowed, otherwise the seconds to wait.
+    ``locked_for`` returns the seconds left on a key's failure lockout.
+    """
+
+    @abstractmethod
+    def hit(self, key: str, limit: int, window: int) -> float:
+        ...
+
+    @abstractmethod
+    def locked_for(self, key: str) -> float:
+        ...
+
+    @abstractmethod
+    def record_failure(self, key: str):
+        ...
+
+    @abstractmethod
+    def clear_failures(self, key: str):
+        ...
+
+
+class _Window:
+    __slots__ = ("start", "previous", "current", "window")
+
+    def __init__(self, start: float, window: int):
+        self.start = start
+        self.previous = 0
+        self.current = 0
+        self.window = window
+
+
+class _Failures:
+    __slots__ = ("count", "locked_until", "last")
+
+    def __init__(self):
+        self.count = 0
+        self.locked_until = 0.0
+        self.last = 0.0
+
+
+class _Shard:
+    __slots__ = ("lock", "windows", "failures", "hits")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.failures = {}
+        self.hits = 0
+
+
+class MemoryBackend(RateLimitBackend):
+    """Sliding-window counters sharded by key hash, local to this process.
+
+    Each key keeps counts for the current and previous fixed window; the
+    previous one is weighted by how much of it still overlaps the sliding
+    window. That is O(1) time and three integers per key.
+    """
+
+    prune_every = 4096
+
+    def __init__(self, shards: int = RATE_LIMIT_SHARDS):
+        self._shards = [_Shard() for _ in range(shards)]
+
+    def _shard(self, key: str) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _prune(self, shard: _Shard, now: float):
+        for key, entry in list(shard.windows.items()):
+            if now - entry.start >= 2 * entry.window:
+                del shard.windows[key]
+        for key, entry in list(shard.failures.items()):
+            if entry.locked_until <= now and now - entry.last >= LOGIN_LOCKOUT_MAX:
+                del shard.failures[key]
+
+    def hit(self, key: str, limit: int, window: int) -> float:
+        now = time.time()
+        start = now - now % window
+        shard = self._shard(key)
+        with shard.lock:
+            shard.hits += 1
+            if shard.hits % self.prune_every == 0:
+                self._prune(shard, now)
+
+            entry = shard.windows.get(key)
+            if entry is None:
+                entry = shard.windows[key] = _Window(start, window)
+            elif entry.start != start:
+                entry.previous = entry.current if start - entry.start == window else 0
+                entry.current = 0
+                entry.start = start
+
+            elapsed = now - start
+            weight = (window - elapsed) / window
+            if entry.previous * weight + entry.current + 1 <= limit:
+                entry.current += 1
+                return 0
+
+            if entry.current + 1 > limit or entry.previous == 0:
+                return window - elapsed
+            # Time until the previous window has decayed enough to fit one more
+            return max(window - elapsed - (limit - 1 - entry.current) * window / entry.previous, 0.001)
+
+    def locked_for(self, key: str) -> float:
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.failures.get(key)
+            return max(entry.locked_until - time.time(), 0) if entry else 0
+
+    def record_failure(self, key: str):
+        now = time.time()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.failures.get(key)
+            if entry is None or now - entry.last >= LOGIN_LOCKOUT_MAX:
+                entry = shard.failures[key] = _Failures()
+            entry.count += 1
+            entry.last = now
+            if entry.count >= LOGIN_LOCKOUT_THRESHOLD:
+                delay = LOGIN_LOCKOUT_BASE * 2 ** (entry.count - LOGIN_LOCKOUT_THRESHOLD)
+                entry.locked_until = now + min(delay, LOGIN_LOCKOUT_MAX)
+
+    def clear_failures(self, key: str):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.failures.pop(key, None)
+
+
+backend: RateLimitBackend = MemoryBackend()
+
+
+def set_backend(new_backend: RateLimitBackend):
+    global backend
+    backend = new_backend
+
+
+def _too_many(retry_after: float, detail: str = "Too many requests, try again later"):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+    )
+
+
+class RateLimiter:
+    def __init__(self, name: str, limit: str):
+        self.name = name
+        self.limit, self.window = parse_limit(limit)
+
+    def check(self, key: str):
+        """Count one request for ``key`` and raise 429 if it is over the limit"""
+        retry_after = backend.hit(f"{self.name}:{key}", self.limit, self.window)
+        if retry_after:
+            raise _too_many(retry_after)
+
+
+login_ip_limiter = RateLimiter("login-ip", LOGIN_RATE_LIMIT_IP)
+login_email_limiter = RateLimiter("login-email", LOGIN_RATE_LIMIT_EMAIL)
+signup_ip_limiter = RateLimiter("signup-ip", SIGNUP_RATE_LIMIT_IP)
+mfa_email_limiter = RateLimiter("mfa-email", MFA_RATE_LIMIT_EMAIL)
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def _account_key(email: str) -> str:
+    return f"login-failures:{email.strip().lower()}"
+
+
+def guard_login(request: Request, email: str):
+    """Throttle a password check by IP and by account before any DB or bcrypt work"""
+    login_ip_limiter.check(client_ip(request))
+    login_email_limiter.check(email.strip().lower())
+
+    locked_for = backend.locked_for(_account_key(email))
+    if locked_for:
+        raise _too_many(locked_for, "Too many failed login attempts, try again later")
+
+
+def record_login_failure(email: str):
+    backend.record_failure(_account_key(email))
+
+
+def clear_login_failures(email: str):
+    backend.clear_failures(_account_key(email))
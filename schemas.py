@@ -0,0 +1,70 @@
+"""Response models shared by the routers.
+
+Declaring these as ``response_model`` lets FastAPI serialize rows straight
+through pydantic-core instead of walking them with ``jsonable_encoder``.
+Routes whose responses vary in shape set ``response_model_exclude_unset``,
+so keys a handler didn't return stay out of the JSON.
+"""
+import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class StatusMessage(BaseModel):
+    status: str
+    message: Optional[str] = None
+
+
+class UserProfile(BaseModel):
+    """One row of model.users.USER_COLUMNS"""
+    id: int
+    email: str
+    username: Optional[str] = None
+    profile_picture: Optional[str] = None
+    is_google_user: Optional[bool] = None
+    mfa_enabled: Optional[bool] = None
+    created_at: Optional[datetime.datetime] = None
+
+
+class LoginResponse(StatusMessage):
+    token: Optional[str] = None
+    refresh_token: Optional[str] = None
+
+
+class UserResponse(StatusMessage):
+    user: UserProfile
+
+
+class UserPage(StatusMessage):
+    users: List[UserProfile] = []
+    next_cursor: Optional[int] = None
+
+
+class UserBatchResult(BaseModel):
+    email: Optional[str] = None
+    id: Optional[int] = None
+    user: Optional[UserProfile] = None
+
+
+class UserBatchResponse(BaseModel):
+    status: str
+    found: int
+    results: List[UserBatchResult]
+
+
+class EmailAvailability(BaseModel):
+    email: str
+    available: bool
+
+
+class MFASetupResponse(BaseModel):
+    status: str
+    qr_code_url: str
+    uri: str
+    qr_code: Optional[str] = None
+
+
+class MFAStatus(BaseModel):
+    mfa_enabled: bool
+    email: str
@@ -0,0 +1,246 @@
+"""Rotating refresh tokens.
+
+Refresh tokens are opaque random strings; only their sha256 is stored, in
+the ``sessions`` table. Every refresh marks the presented token rotated and
+issues a new one in the same family. If a rotated token is presented
+again, someone kept a copy, so the whole family is revoked.
+
+Each worker also keeps an in-memory index of the sessions it has seen
+and the families it has revoked. This lets a worker reject a known-dead
+token without a query. It also lets auth_tokens refuse access tokens
+whose session was logged out here. Other workers learn about revoked
+families on their next refresh through the table.
+"""
+import datetime
+import hashlib
+import heapq
+import os
+import secrets
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from metrics import gauge, timed
+
+REFRESH_TOKEN_TTL_DAYS = int(os.getenv("REFRESH_TOKEN_TTL_DAYS", "30"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "50000"))
+# Expiry wheel granularity; entries live at most this much past their expiry
+SESSION_WHEEL_SECONDS = 60
+
+
+class SessionRecord:
+    __slots__ = ("user_id", "family", "subject", "expires_at", "rotated")
+
+    def __init__(self, user_id, family, subject, expires_at, rotated=False):
+        self.user_id = user_id
+        self.family = family
+        self.subject = subject
+        self.expires_at = expires_at
+        self.rotated = rotated
+
+
+class ExpiryWheel:
+    """Buckets keys by expiry time so eviction pops whole buckets, never scans"""
+
+    def __init__(self, slot_seconds=SESSION_WHEEL_SECONDS):
+        self.slot_seconds = slot_seconds
+        self._slots = {}
+        self._order = []
+
+    def add(self, key, expires_at):
+        slot = int(expires_at // self.slot_seconds) + 1
+        keys = self._slots.get(slot)
+        if keys is None:
+            keys = self._slots[slot] = []
+            heapq.heappush(self._order, slot)
+        keys.append(key)
+
+    def pop_expired(self, now):
+        current = int(now // self.slot_seconds)
+        expired = []
+        while self._order and self._order[0] <= current:
+            expired.extend(self._slots.pop(heapq.heappop(self._order)))
+        return expired
+
+
+class SessionIndex:
+    """Sessions by refresh-token digest, plus revoked families, until they expire"""
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE):
+        self.max_size = max_size
+        self._records = {}
+        # family -> digests of its sessions in _records, so revoking one never scans
+        self._families = {}
+        self._revoked = {}
+        self._wheel = ExpiryWheel()
+
+    def _drop(self, digest):
+        record = self._records.pop(digest)
+        digests = self._families.get(record.family)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._families[record.family]
+
+    def _evict(self, now):
+        for kind, key in self._wheel.pop_expired(now):
+            if kind == "session":
+                record = self._records.get(key)
+                if record is not None and record.expires_at <= now:
+                    self._drop(key)
+            else:
+                expires_at = self._revoked.get(key)
+                if expires_at is not None and expires_at <= now:
+                    del self._revoked[key]
+
+    def get(self, digest):
+        self._evict(time.time())
+        return self._records.get(digest)
+
+    def add(self, digest, record):
+        if digest in self._records:
+            self._drop(digest)
+        self._records[digest] = record
+        self._families.setdefault(record.family, set()).add(digest)
+        self._wheel.add(("session", digest), record.expires_at)
+        if len(self._records) > self.max_size:
+            # Insertion order; the oldest sessions are the first to go
+            self._drop(next(iter(self._records)))
+
+    def revoke_family(self, family, expires_at):
+        self._revoked[family] = expires_at
+        self._wheel.add(("family", family), expires_at)
+        for digest in self._families.pop(family, ()):
+            del self._records[digest]
+
+    def is_revoked(self, family):
+        return family in self._revoked
+
+    def __len__(self):
+        return len(self._records)
+
+
+session_index = SessionIndex()
+
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def _unauthorized(detail: str):
+    return HTTPException(status_code=401, detail=detail)
+
+
+def _new_expiry():
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=REFRESH_TOKEN_TTL_DAYS)
+
+
+def is_session_revoked(family) -> bool:
+    return family is not None and session_index.is_revoked(family)
+
+
+async def start_session(db, user_id: int, subject: str):
+    """Create a session and return (family, refresh token)"""
+    token = secrets.token_urlsafe(32)
+    family = str(uuid.uuid4())
+    expires_at = _new_expiry()
+    async with db.connection() as conn:
+        with timed("db_session_insert"):
+            await conn.execute(
+                """INSERT INTO sessions (token_hash, family, user_id, subject, expires_at)
+                   VALUES (%s, %s, %s, %s, %s)""",
+                (_digest(token), family, user_id, subject, expires_at)
+            )
+            await conn.commit()
+    session_index.add(
+        _digest(token), SessionRecord(user_id, family, subject, expires_at.timestamp())
+    )
+    return family, token
+
+
+async def _revoke_family(db, family, expires_at):
+    session_index.revoke_family(family, expires_at)
+    async with db.connection() as conn:
+        with timed("db_session_revoke"):
+            await conn.execute(
+                "UPDATE sessions SET revoked_at = now() WHERE family = %s AND revoked_at IS NULL",
+                (family,)
+            )
+            await conn.commit()
+
+
+async def rotate_session(db, token: str):
+    """Swap a refresh token for a new one; returns (SessionRecord, new refresh token)"""
+    digest = _digest(token)
+    now = time.time()
+
+    known = session_index.get(digest)
+    if known is not None:
+        if session_index.is_revoked(known.family) or known.expires_at <= now:
+            raise _unauthorized("Invalid refresh token")
+        if known.rotated:
+            await _revoke_family(db, known.family, known.expires_at)
+            raise _unauthorized("Refresh token reuse detected")
+
+    new_token = secrets.token_urlsafe(32)
+    new_digest = _digest(new_token)
+    expires_at = _new_expiry()
+    async with db.connection() as conn:
+        with timed("db_session_rotate"):
+            # One statement: retire the presented token and add its successor
+            cur = await conn.execute(
+                """WITH used AS (
+                       UPDATE sessions SET rotated_at = now()
+                       WHERE token_hash = %s AND rotated_at IS NULL
+                         AND revoked_at IS NULL AND expires_at > now()
+                       RETURNING family, user_id, subject
+                   )
+                   INSERT INTO sessions (token_hash, family, user_id, subject, expires_at)
+                   SELECT %s, family, user_id, subject, %s FROM used
+                   RETURNING user_id, family, subject""",
+                (digest, new_digest, expires_at)
+            )
+            row = await cur.fetchone()
+            if row is None:
+                cur = await conn.execute(
+                    """SELECT family, rotated_at IS NOT NULL AND revoked_at IS NULL,
+                              extract(epoch FROM expires_at)
+                       FROM sessions WHERE token_hash = %s""",
+                    (digest,)
+                )
+                stale = await cur.fetchone()
+            await conn.commit()
+
+    if row is None:
+        if stale is not None and stale[1]:
+            await _revoke_family(db, str(stale[0]), float(stale[2]))
+            raise _unauthorized("Refresh token reuse detected")
+        raise _unauthorized("Invalid refresh token")
+
+    user_id, family, subject = row
+    family = str(family)
+    if known is not None:
+        known.rotated = True
+    else:
+        session_index.add(digest, SessionRecord(user_id, family, subject, expires_at.timestamp(), rotated=True))
+    record = SessionRecord(user_id, family, subject, expires_at.timestamp())
+    session_index.add(new_digest, record)
+    return record, new_token
+
+
+async def end_session(db, token: str):
+    """Revoke the session a refresh token belongs to; unknown tokens are ignored"""
+    async with db.connection() as conn:
+        cur = await conn.execute(
+            "SELECT family, extract(epoch FROM expires_at) FROM sessions WHERE token_hash = %s",
+            (_digest(token),)
+        )
+        row = await cur.fetchone()
+    if row is not None:
+        await _revoke_family(db, str(row[0]), float(row[1]))
+
+
+@gauge("session_index_entries", "Refresh-token sessions held in this worker's index")
+def _index_size():
+    return [({}, len(session_index))]
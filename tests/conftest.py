@@ -0,0 +1,75 @@
+import os
+import sys
+
+# Tests import the app modules from the repository root. Set before any of them is imported.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TEST_ENV = {
+    "JWT_SECRET": "test-secret",
+    "GOOGLE_CLIENT_ID": "test-client",
+    "GOOGLE_CLIENT_SECRET": "test-client-secret",
+    "GOOGLE_REDIRECT_URI": "http://localhost:8000/auth/google/callback",
+    "MFA_RATE_LIMIT_EMAIL": "1000000/second",
+    "DB_AUTO_MIGRATE": "true",
+}
+for _name, _value in TEST_ENV.items():
+    os.environ.setdefault(_name, _value)
+
+import json  # noqa: E402
+import urllib.parse  # noqa: E402
+import uuid  # noqa: E402
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+from model.config import DATABASE_URL  # noqa: E402
+
+COMPANY_URL = "http://localhost:3000"
+
+requires_db = pytest.mark.skipif(not DATABASE_URL, reason="needs a Postgres in DATABASE_URL")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def google_emails():
+    run_id = uuid.uuid4().hex[:8]
+    return [f"test-{run_id}-{n}@example.com" for n in range(4)]
+
+
+@pytest.fixture
+async def client(google_emails, monkeypatch):
+    """main:app in-process, with Google's endpoints served by httpx.MockTransport"""
+    import google_client
+    from benchmarks.google_mock import GoogleMock
+    from google_auth import GOOGLE_CLIENT_ID
+    from main import app
+    from model.database import get_pool
+
+    # Each mock signs with a fresh key under the same kid
+    monkeypatch.setattr(google_client, "google_keys", google_client.GoogleKeySet())
+    google_client.open_client(GoogleMock(GOOGLE_CLIENT_ID, google_emails).transport())
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            try:
+                yield http
+            finally:
+                pool = await get_pool()
+                async with pool.connection() as conn:
+                    await conn.execute("DELETE FROM users WHERE email = ANY(%s)", (google_emails,))
+                    await conn.commit()
+
+
+async def google_login(client, account=0):
+    """Sign in as the ``account``-th Google user; returns (access token, refresh token)"""
+    state = urllib.parse.quote(json.dumps({"company_url": COMPANY_URL}))
+    response = await client.get("/auth/google/callback", params={"code": str(account), "state": state})
+    assert response.status_code == 307
+    location = urllib.parse.urlparse(response.headers["location"])
+    assert "refresh_token" not in location.query
+    query = urllib.parse.parse_qs(location.query)
+    fragment = urllib.parse.parse_qs(location.fragment)
+    return query["token"][0], fragment["refresh_token"][0]
@@ -0,0 +1,113 @@
+import datetime
+import time
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+import auth_tokens
+import sessions
+from auth_tokens import revoke_token, verify_token
+from google_auth import ALGORITHM, SECRET_KEY, create_access_token
+from sessions import SessionIndex
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(auth_tokens, "_verified", type(auth_tokens._verified)())
+    monkeypatch.setattr(auth_tokens, "_revoked", {})
+    monkeypatch.setattr(auth_tokens, "_revoked_wheel", sessions.ExpiryWheel())
+    monkeypatch.setattr(sessions, "session_index", SessionIndex())
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """Count signature checks, to tell cache hits from misses"""
+    calls = []
+    real_decode = jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        calls.append(args[0])
+        return real_decode(*args, **kwargs)
+    monkeypatch.setattr(auth_tokens.jwt, "decode", counting_decode)
+    return calls
+
+
+def token(minutes=5, **claims):
+    return create_access_token({"sub": "42", **claims}, expires_delta=datetime.timedelta(minutes=minutes))
+
+
+def rejected(token_value):
+    with pytest.raises(HTTPException) as raised:
+        verify_token(token_value)
+    assert raised.value.status_code == 401
+    return raised.value.detail
+
+
+def test_verified_tokens_are_cached(decodes):
+    value = token()
+    assert verify_token(value)["sub"] == "42"
+    assert verify_token(value)["sub"] == "42"
+    assert len(decodes) == 1
+
+
+def test_cache_is_bounded(monkeypatch, decodes):
+    monkeypatch.setattr(auth_tokens, "TOKEN_CACHE_SIZE", 2)
+    values = [token(sub=str(n)) for n in range(3)]
+    for value in values:
+        verify_token(value)
+    verify_token(values[0])
+    assert len(decodes) == 4
+
+
+def test_cached_token_still_expires(monkeypatch):
+    value = token()
+    verify_token(value)
+    later = time.time() + 10 * 60
+    monkeypatch.setattr(auth_tokens.time, "time", lambda: later)
+    assert rejected(value) == "Token has expired"
+
+
+def test_invalid_and_expired_tokens():
+    assert rejected("not-a-token") == "Invalid token"
+    forged = jwt.encode({"sub": "42", "exp": time.time() + 60}, "other-secret", algorithm=ALGORITHM)
+    assert rejected(forged) == "Invalid token"
+    no_exp = jwt.encode({"sub": "42"}, SECRET_KEY, algorithm=ALGORITHM)
+    assert rejected(no_exp) == "Invalid token"
+    assert rejected(token(minutes=-1)) == "Token has expired"
+
+
+def test_revoked_token_is_rejected_even_when_cached():
+    value = token()
+    verify_token(value)
+    revoke_token(value)
+    assert auth_tokens.is_revoked(value)
+    assert rejected(value) == "Token has been revoked"
+    # Other tokens are unaffected
+    assert verify_token(token(sub="7"))["sub"] == "7"
+
+
+def test_revoked_tokens_are_dropped_once_expired(monkeypatch):
+    value = token()
+    revoke_token(value)
+    later = time.time() + 10 * 60
+    monkeypatch.setattr(auth_tokens.time, "time", lambda: later)
+    revoke_token(token(minutes=20, sub="7"))
+    assert not auth_tokens.is_revoked(value)
+    assert len(auth_tokens._revoked) == 1
+
+
+def test_ended_session_rejects_its_access_tokens():
+    value = token(sid="family-1")
+    verify_token(value)
+    sessions.session_index.revoke_family("family-1", time.time() + 60)
+    assert rejected(value) == "Session has ended"
+    assert rejected(token(sid="family-1")) == "Session has ended"
+    assert verify_token(token(sid="family-2"))["sid"] == "family-2"
+
+
+def test_introspect_reports_inactive_tokens():
+    value = token()
+    assert auth_tokens._introspect(value)["active"] is True
+    revoke_token(value)
+    assert auth_tokens._introspect(value) == {"active": False}
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+from psycopg_pool import AsyncConnectionPool, PoolClosed, PoolTimeout
+
+from model import database
+from model.database import CircuitBreaker, DatabaseUnavailable, InstrumentedPool
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    fresh = CircuitBreaker(threshold=3, cooldown=10)
+    monkeypatch.setattr(database, "breaker", fresh)
+    return fresh
+
+
+@pytest.fixture
+def pool():
+    return InstrumentedPool("postgresql://unused", open=False)
+
+
+def checkout_with(monkeypatch, behaviour):
+    """Make the base pool's getconn run ``behaviour`` instead of touching a database"""
+    async def getconn(self, timeout=None):
+        return await behaviour()
+    monkeypatch.setattr(AsyncConnectionPool, "getconn", getconn)
+
+
+async def timeout():
+    raise PoolTimeout("timed out")
+
+
+async def connected():
+    return "conn"
+
+
+def expire_cooldown(breaker):
+    breaker.opened_at -= breaker.cooldown + 1
+
+
+def test_opens_after_consecutive_timeouts(monkeypatch, breaker, pool):
+    checkout_with(monkeypatch, timeout)
+    for _ in range(3):
+        with pytest.raises(DatabaseUnavailable):
+            asyncio.run(pool.getconn())
+    assert breaker.state == breaker.OPEN
+
+    # Refused straight away, without reaching the pool
+    checkout_with(monkeypatch, connected)
+    with pytest.raises(DatabaseUnavailable) as raised:
+        asyncio.run(pool.getconn())
+    assert raised.value.detail == "Database unavailable"
+    assert raised.value.status_code == 503
+
+
+def test_success_resets_failure_count(monkeypatch, breaker, pool):
+    for _ in range(3):
+        checkout_with(monkeypatch, timeout)
+        for _ in range(2):
+            with pytest.raises(DatabaseUnavailable):
+                asyncio.run(pool.getconn())
+        checkout_with(monkeypatch, connected)
+        assert asyncio.run(pool.getconn()) == "conn"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_trial_success_closes(monkeypatch, breaker, pool):
+    checkout_with(monkeypatch, timeout)
+    for _ in range(3):
+        with pytest.raises(DatabaseUnavailable):
+            asyncio.run(pool.getconn())
+    expire_cooldown(breaker)
+
+    checkout_with(monkeypatch, connected)
+    assert asyncio.run(pool.getconn()) == "conn"
+    assert breaker.state == breaker.CLOSED
+
+
+def test_trial_timeout_reopens(monkeypatch, breaker, pool):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_failure()
+    expire_cooldown(breaker)
+
+    checkout_with(monkeypatch, timeout)
+    with pytest.raises(DatabaseUnavailable):
+        asyncio.run(pool.getconn())
+    assert breaker.state == breaker.OPEN
+    assert breaker.retry_after() > 0
+
+
+@pytest.mark.parametrize("error", [PoolClosed, RuntimeError])
+def test_trial_ending_in_other_errors_reopens(monkeypatch, breaker, pool, error):
+    for _ in range(3):
+        breaker.record_failure()
+    expire_cooldown(breaker)
+
+    async def fail():
+        raise error("gone")
+    checkout_with(monkeypatch, fail)
+    with pytest.raises(error):
+        asyncio.run(pool.getconn())
+    assert breaker.state == breaker.OPEN
+
+
+def test_cancelled_trial_reopens(monkeypatch, breaker, pool):
+    for _ in range(3):
+        breaker.record_failure()
+    expire_cooldown(breaker)
+
+    checkout_with(monkeypatch, lambda: asyncio.sleep(60))
+
+    async def cancel_trial():
+        task = asyncio.create_task(pool.getconn())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(cancel_trial())
+    assert breaker.state == breaker.OPEN
+
+    # The next trial after the cooldown can still close it
+    expire_cooldown(breaker)
+    checkout_with(monkeypatch, connected)
+    assert asyncio.run(pool.getconn()) == "conn"
+    assert breaker.state == breaker.CLOSED
@@ -0,0 +1,58 @@
+import bcrypt
+import pytest
+
+import password_hashing
+from password_hashing import encode_stored_hash, needs_rehash
+
+
+@pytest.fixture
+def cost(monkeypatch):
+    monkeypatch.setattr(password_hashing, "_cost", 11)
+
+
+def stored(rounds):
+    return encode_stored_hash(bcrypt.hashpw(b"pw", bcrypt.gensalt(rounds)))
+
+
+def test_weaker_hash_is_rehashed(cost):
+    assert needs_rehash(stored(10))
+
+
+def test_same_or_stronger_hash_is_kept(cost):
+    assert not needs_rehash(stored(11))
+    assert not needs_rehash(stored(12))
+
+
+def test_legacy_format_is_rehashed(cost):
+    legacy = "\\x" + bcrypt.hashpw(b"pw", bcrypt.gensalt(12)).hex()
+    assert needs_rehash(legacy)
+
+
+def test_calibration_keeps_the_floor(monkeypatch):
+    monkeypatch.setattr(password_hashing, "_cost", None)
+    monkeypatch.setattr(password_hashing, "PASSWORD_HASH_TARGET_MS", 0.001)
+    assert password_hashing.calibrate_cost() == password_hashing.PASSWORD_HASH_MIN_COST
+
+
+@pytest.mark.anyio
+async def test_background_rehash_drops_a_busy_hash(monkeypatch):
+    import user_controller
+    from fastapi import HTTPException
+
+    async def busy(password):
+        raise HTTPException(status_code=503, detail="Server busy")
+
+    monkeypatch.setattr(user_controller, "hash_password", busy)
+    monkeypatch.setitem(user_controller._rehash_skipped, "hash_busy", 0)
+    await user_controller._rehash_password(None, 1, "pw", stored(10))
+    assert user_controller._rehash_skipped["hash_busy"] == 1
+
+
+@pytest.mark.anyio
+async def test_batch_hashes_keep_their_order(monkeypatch):
+    monkeypatch.setattr(password_hashing, "_cost", 4)
+    monkeypatch.setattr(password_hashing, "_pool", password_hashing.WorkerPool("thread", 2, "test-hash"))
+    passwords = [f"pw-{n}" for n in range(5)]
+    hashes = await password_hashing.hash_passwords(passwords)
+    assert all(bcrypt.checkpw(p.encode(), h) for p, h in zip(passwords, hashes))
+    password_hashing._pool.shutdown()
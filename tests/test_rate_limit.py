@@ -0,0 +1,103 @@
+import pytest
+from fastapi import HTTPException
+
+import rate_limit
+from rate_limit import MemoryBackend, RateLimitBackend, RateLimiter, parse_limit
+
+
+class Clock:
+    def __init__(self, now=1_000_020.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(rate_limit.time, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    fresh = MemoryBackend()
+    monkeypatch.setattr(rate_limit, "backend", fresh)
+    return fresh
+
+
+def test_parse_limit():
+    assert parse_limit("5/minute") == (5, 60)
+    assert parse_limit("10 / hours") == (10, 3600)
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        RateLimitBackend()
+
+
+def test_allows_up_to_limit_then_reports_wait(clock, backend):
+    for _ in range(3):
+        assert backend.hit("k", 3, 60) == 0
+    retry_after = backend.hit("k", 3, 60)
+    assert 0 < retry_after <= 60
+
+
+def test_keys_are_independent(clock, backend):
+    for _ in range(3):
+        backend.hit("a", 3, 60)
+    assert backend.hit("a", 3, 60)
+    assert backend.hit("b", 3, 60) == 0
+
+
+def test_previous_window_decays(clock, backend):
+    clock.now = 1_000_020.0  # a multiple of 60, so a window starts here
+    for _ in range(3):
+        backend.hit("k", 3, 60)
+    # Right after the window rolls over the previous window still counts fully
+    clock.now += 60 - clock.now % 60 + 1
+    assert backend.hit("k", 3, 60) > 0
+    # Most of the way through, enough of it has decayed
+    clock.now += 50
+    assert backend.hit("k", 3, 60) == 0
+
+
+def test_lockout_doubles_and_clears(clock, backend, monkeypatch):
+    monkeypatch.setattr(rate_limit, "LOGIN_LOCKOUT_THRESHOLD", 3)
+    monkeypatch.setattr(rate_limit, "LOGIN_LOCKOUT_BASE", 1)
+    for _ in range(2):
+        backend.record_failure("acct")
+    assert backend.locked_for("acct") == 0
+
+    backend.record_failure("acct")
+    assert backend.locked_for("acct") == pytest.approx(1)
+    backend.record_failure("acct")
+    assert backend.locked_for("acct") == pytest.approx(2)
+
+    backend.clear_failures("acct")
+    assert backend.locked_for("acct") == 0
+
+
+def test_limiter_raises_429_with_retry_after(clock, backend):
+    limiter = RateLimiter("test", "2/minute")
+    limiter.check("k")
+    limiter.check("k")
+    with pytest.raises(HTTPException) as raised:
+        limiter.check("k")
+    assert raised.value.status_code == 429
+    assert int(raised.value.headers["Retry-After"]) >= 1
+
+
+def test_guard_login_blocks_locked_account(clock, backend, monkeypatch):
+    monkeypatch.setattr(rate_limit, "LOGIN_LOCKOUT_THRESHOLD", 1)
+
+    class FakeRequest:
+        client = None
+
+    rate_limit.record_login_failure("User@Example.com ")
+    with pytest.raises(HTTPException) as raised:
+        rate_limit.guard_login(FakeRequest(), "user@example.com")
+    assert raised.value.status_code == 429
+    rate_limit.clear_login_failures("user@example.com")
+    rate_limit.guard_login(FakeRequest(), "user@example.com")
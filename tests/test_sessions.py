@@ -0,0 +1,131 @@
+import pytest
+
+import sessions
+from conftest import google_login, requires_db
+from sessions import ExpiryWheel, SessionIndex, SessionRecord
+
+
+def test_expiry_wheel_pops_whole_past_slots():
+    wheel = ExpiryWheel(slot_seconds=10)
+    wheel.add("a", 105)
+    wheel.add("b", 108)
+    wheel.add("c", 125)
+    assert wheel.pop_expired(105) == []
+    assert sorted(wheel.pop_expired(110)) == ["a", "b"]
+    assert wheel.pop_expired(125) == []
+    assert wheel.pop_expired(130) == ["c"]
+
+
+def test_session_index_evicts_expired_and_revoked(monkeypatch):
+    index = SessionIndex()
+    now = 1_000_000.0
+    monkeypatch.setattr(sessions.time, "time", lambda: now)
+    index.add(b"live", SessionRecord(1, "f1", "1", now + 3600))
+    index.add(b"old", SessionRecord(1, "f2", "1", now - 120))
+    assert index.get(b"old") is None
+    assert index.get(b"live").family == "f1"
+
+    index.revoke_family("f1", now + 3600)
+    assert index.is_revoked("f1")
+    assert index.get(b"live") is None
+
+
+def test_revoking_a_family_keeps_the_others():
+    index = SessionIndex()
+    for n, family in enumerate(["f1", "f1", "f2"]):
+        index.add(bytes([n]), SessionRecord(1, family, "1", 4_000_000_000))
+    index.revoke_family("f1", 4_000_000_000)
+    assert len(index) == 1
+    assert index.get(bytes([2])).family == "f2"
+    assert "f1" not in index._families
+
+
+def test_session_index_is_bounded():
+    index = SessionIndex(max_size=2)
+    for n in range(3):
+        index.add(bytes([n]), SessionRecord(1, f"f{n}", "1", 4_000_000_000))
+    assert len(index) == 2
+    assert index.get(bytes([0])) is None
+
+
+async def refresh(client, refresh_token):
+    return await client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+
+async def active(client, token):
+    response = await client.post("/introspect", json={"token": token})
+    return response.json()["active"]
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_refresh_rotates_tokens(client):
+    access, first = await google_login(client)
+    assert await active(client, access)
+
+    response = await refresh(client, first)
+    assert response.status_code == 200
+    second = response.json()["refresh_token"]
+    assert second != first
+    assert await active(client, response.json()["token"])
+
+    response = await refresh(client, second)
+    assert response.status_code == 200
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_reused_refresh_token_revokes_the_family(client):
+    access, first = await google_login(client)
+    response = await refresh(client, first)
+    second = response.json()["refresh_token"]
+    refreshed_access = response.json()["token"]
+
+    response = await refresh(client, first)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Refresh token reuse detected"
+
+    # Every token in the family is dead now, including the legitimate successor
+    assert (await refresh(client, second)).status_code == 401
+    assert not await active(client, access)
+    assert not await active(client, refreshed_access)
+
+    # Other sessions carry on
+    other_access, other_refresh = await google_login(client, account=1)
+    assert await active(client, other_access)
+    assert (await refresh(client, other_refresh)).status_code == 200
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_reuse_is_detected_by_a_worker_that_never_saw_the_session(client, monkeypatch):
+    _, first = await google_login(client)
+    assert (await refresh(client, first)).status_code == 200
+
+    # A different worker: nothing in memory, only the sessions table
+    monkeypatch.setattr(sessions, "session_index", SessionIndex())
+    response = await refresh(client, first)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Refresh token reuse detected"
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_unknown_refresh_token_is_rejected(client):
+    response = await refresh(client, "not-a-refresh-token")
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Invalid refresh token"
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_logout_ends_the_session_and_revokes_the_bearer_token(client):
+    access, refresh_token = await google_login(client)
+    response = await client.post(
+        "/logout",
+        json={"refresh_token": refresh_token},
+        headers={"Authorization": f"Bearer {access}"},
+    )
+    assert response.status_code == 200
+    assert not await active(client, access)
+    assert (await refresh(client, refresh_token)).status_code == 401
@@ -0,0 +1,112 @@
+import urllib.parse
+
+import pyotp
+import pytest
+
+import mfa_authenticator
+from conftest import google_login, requires_db
+from totp_engine import TOTP_INTERVAL, TOTPVerifier
+
+SECRET = pyotp.random_base32()
+EMAIL = "user@example.com"
+NOW = 1_700_000_000.0
+
+
+def verifier():
+    v = TOTPVerifier()
+    v.store_secret(EMAIL, SECRET)
+    return v
+
+
+def code_at(when):
+    return pyotp.TOTP(SECRET).at(when)
+
+
+def test_accepts_current_and_adjacent_steps():
+    for offset in (-TOTP_INTERVAL, 0, TOTP_INTERVAL):
+        assert verifier().verify(EMAIL, code_at(NOW + offset), now=NOW)
+
+
+def test_rejects_codes_outside_the_window():
+    assert not verifier().verify(EMAIL, code_at(NOW - 2 * TOTP_INTERVAL), now=NOW)
+    assert not verifier().verify(EMAIL, "000000" if code_at(NOW) != "000000" else "111111", now=NOW)
+
+
+def test_match_returns_the_accepted_step():
+    step = int(NOW // TOTP_INTERVAL)
+    assert verifier().match(EMAIL, code_at(NOW - TOTP_INTERVAL), now=NOW) == step - 1
+
+
+def test_code_is_accepted_once():
+    v = verifier()
+    code = code_at(NOW)
+    assert v.verify(EMAIL, code, now=NOW)
+    assert not v.verify(EMAIL, code, now=NOW)
+    assert not v.verify(EMAIL, code, now=NOW + TOTP_INTERVAL)
+
+
+def test_earlier_step_rejected_after_later_one_used():
+    v = verifier()
+    assert v.verify(EMAIL, code_at(NOW), now=NOW)
+    assert not v.verify(EMAIL, code_at(NOW - TOTP_INTERVAL), now=NOW)
+
+
+def test_replay_tracking_survives_a_new_secret():
+    v = verifier()
+    code = code_at(NOW)
+    assert v.verify(EMAIL, code, now=NOW)
+    v.invalidate(EMAIL)
+    v.store_secret(EMAIL, SECRET)
+    assert not v.verify(EMAIL, code, now=NOW)
+
+
+def test_old_buckets_are_pruned():
+    v = verifier()
+    assert v.verify(EMAIL, code_at(NOW), now=NOW)
+    later = NOW + 10 * TOTP_INTERVAL
+    assert v.verify(EMAIL, code_at(later), now=later)
+    assert min(v._consumed) >= int(later // TOTP_INTERVAL) - 1
+
+
+async def enroll(client, email):
+    response = await client.post("/setup_mfa", params={"email": email, "qr_format": "url"})
+    assert response.status_code == 200
+    uri = response.json()["uri"]
+    return pyotp.TOTP(urllib.parse.parse_qs(urllib.parse.urlparse(uri).query)["secret"][0])
+
+
+async def verify(client, email, code):
+    response = await client.post("/verify_mfa", params={"email": email, "code": code})
+    return response.status_code
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_code_replayed_against_another_worker_is_rejected(client, google_emails, monkeypatch):
+    email = google_emails[0]
+    await google_login(client)
+    totp = await enroll(client, email)
+    code = totp.now()
+    assert await verify(client, email, code) == 200
+    assert await verify(client, email, code) == 401
+
+    # Another worker: no cached secret and no record of used codes in memory
+    monkeypatch.setattr(mfa_authenticator, "totp_verifier", TOTPVerifier())
+    assert await verify(client, email, code) == 401
+
+
+@requires_db
+@pytest.mark.anyio
+async def test_qr_code_is_only_served_while_enrollment_is_pending(client, google_emails):
+    email = google_emails[0]
+    access, _ = await google_login(client)
+    headers = {"Authorization": f"Bearer {access}"}
+    totp = await enroll(client, email)
+
+    response = await client.get(f"/mfa_qr/{email}", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+
+    assert await verify(client, email, totp.now()) == 200
+    response = await client.get(f"/mfa_qr/{email}", headers=headers)
+    assert response.status_code == 404
@@ -0,0 +1,121 @@
+import hashlib
+import hmac
+import os
+import struct
+import time
+from collections import OrderedDict
+
+import pyotp
+
+TOTP_INTERVAL = 30
+TOTP_DIGITS = 6
+TOTP_VALID_WINDOW = 1
+TOTP_SECRET_CACHE_SIZE = int(os.getenv("TOTP_SECRET_CACHE_SIZE", "10000"))
+# Bounds how long another worker's setup_mfa can go unnoticed here
+TOTP_SECRET_TTL = int(os.getenv("TOTP_SECRET_TTL", "300"))
+
+
+def _hotp(key: bytes, counter: int) -> str:
+    digest = hmac.new(key, struct.pack(">Q", counter), hashlib.sha1).digest()
+    offset = digest[-1] & 0x0F
+    value = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(value % 10 ** TOTP_DIGITS).zfill(TOTP_DIGITS)
+
+
+class _UserTOTP:
+    __slots__ = ("key", "expires_at", "step", "codes")
+
+    def __init__(self, key: bytes, expires_at: float):
+        self.key = key
+        self.expires_at = expires_at
+        self.step = None
+        self.codes = ()
+
+
+class TOTPVerifier:
+    """Verifies TOTP codes from cached secrets and rejects replayed codes.
+
+    Decoded secrets are kept in an LRU per email for TOTP_SECRET_TTL seconds,
+    and the accepted codes for the current +/-TOTP_VALID_WINDOW steps are
+    computed once per step. Used codes are recorded as (email, step) pairs
+    bucketed by step, and buckets older than the window are dropped as time
+    moves on.
+
+    All of this is per process, so it only catches replays that come back
+    to the same worker. Callers make an accepted step stick across workers
+    by claiming it on the user row (``model.queries.claim_totp_step``).
+    """
+
+    def __init__(self, max_users: int = TOTP_SECRET_CACHE_SIZE):
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._consumed = {}
+
+    def has_secret(self, email: str) -> bool:
+        user = self._users.get(email)
+        if user is None:
+            return False
+        if user.expires_at <= time.monotonic():
+            del self._users[email]
+            return False
+        return True
+
+    def store_secret(self, email: str, user_secret: str):
+        self._users[email] = _UserTOTP(
+            pyotp.TOTP(user_secret).byte_secret(), time.monotonic() + TOTP_SECRET_TTL
+        )
+        self._users.move_to_end(email)
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, email: str):
+        """Forget a user's secret, e.g. after setup_mfa issues a new one or the user is deleted"""
+        self._users.pop(email, None)
+
+    def _window(self, user: _UserTOTP, step: int):
+        if user.step != step:
+            user.codes = tuple(
+                (s, _hotp(user.key, s))
+                for s in range(step - TOTP_VALID_WINDOW, step + TOTP_VALID_WINDOW + 1)
+            )
+            user.step = step
+        return user.codes
+
+    def _prune(self, step: int):
+        oldest = step - TOTP_VALID_WINDOW
+        for bucket in [s for s in self._consumed if s < oldest]:
+            del self._consumed[bucket]
+
+    def verify(self, email: str, code: str, now: float | None = None) -> bool:
+        """Check ``code`` for a user whose secret is already stored.
+
+        A code is accepted at most once, and never for a step at or before
+        one the user has already used.
+        """
+        return self.match(email, code, now) is not None
+
+    def match(self, email: str, code: str, now: float | None = None) -> int | None:
+        """Like ``verify``, but return the time step the code was accepted for"""
+        user = self._users[email]
+        self._users.move_to_end(email)
+        step = int((time.time() if now is None else now) // TOTP_INTERVAL)
+        self._prune(step)
+
+        code = str(code).strip()
+        matched = None
+        for code_step, expected in self._window(user, step):
+            if hmac.compare_digest(code, expected):
+                matched = code_step
+
+        if matched is None:
+            return None
+
+        for used_step in range(matched, step + TOTP_VALID_WINDOW + 1):
+            if email in self._consumed.get(used_step, ()):
+                return None
+
+        self._consumed.setdefault(matched, set()).add(email)
+        return matched
+
+
+totp_verifier = TOTPVerifier()
@@ -1,67 +1,54 @@
-import os
-from typing import Optional
-import bcrypt
+from typing import List, Optional
 import datetime
-import json
-from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Depends, HTTPException, APIRouter
-from fastapi.responses import RedirectResponse
+import os
+from fastapi import BackgroundTasks, Request, Response, Depends, Header, HTTPException, APIRouter, Query
+from fastapi.responses import StreamingResponse
+import orjson
 from pydantic import BaseModel
-from authlib.integrations.starlette_client import OAuth
-from starlette.config import Config
-from starlette.middleware.sessions import SessionMiddleware
-from starlette.responses import JSONResponse
 from google_auth import create_access_token
-from model.config import conn 
-from psycopg2 import Error, pool
-import datetime
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-
-from model.users import create_users
+import psycopg
+from psycopg.errors import UniqueViolation
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+import audit
+import email_index
+from breached_passwords import ensure_not_breached
+from metrics import gauge, timed
+from model import queries
+from model.database import DatabaseUnavailable, get_pool
+from model.users import USER_COLUMNS
+from password_hashing import (
+    check_password,
+    decode_stored_hash,
+    encode_stored_hash,
+    hash_password,
+    needs_rehash,
+)
+import profile_cache
+from rate_limit import (
+    client_ip,
+    clear_login_failures,
+    guard_login,
+    record_login_failure,
+    signup_ip_limiter,
+)
+from schemas import (
+    EmailAvailability,
+    LoginResponse,
+    StatusMessage,
+    UserBatchResponse,
+    UserPage,
+    UserResponse,
+)
+from sessions import start_session
+from totp_engine import totp_verifier
 
 
 
 router = APIRouter()
-app = FastAPI()
-
-load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-pg_pool = pool.SimpleConnectionPool(1, 10, DATABASE_URL)
-
-app.add_middleware(SessionMiddleware, secret_key=os.getenv("GOOGLE_SECRET_KEY"))
-GOOGLE_CLIENT_ID =  os.getenv("GOOGLE_CLIENT_ID")
-GOOGLE_CLIENT_SECRET =  os.getenv("GOOGLE_CLIENT_SECRET")
-SECRET_KEY =  os.getenv("GOOGLE_SECRET_KEY")
-
-
-
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
-config_data = {
-    "GOOGLE_CLIENT_ID": GOOGLE_CLIENT_ID,
-    "GOOGLE_CLIENT_SECRET": GOOGLE_CLIENT_SECRET,
-    "SECRET_KEY": SECRET_KEY,
-}
-config = Config(environ=config_data)
-oauth = OAuth(config)
-
-google = oauth.register(
-    name="google",
-    client_id=config_data["GOOGLE_CLIENT_ID"],
-    client_secret=config_data["GOOGLE_CLIENT_SECRET"],
-    access_token_url="https://oauth2.googleapis.com/token",
-    authorize_url="https://accounts.google.com/o/oauth2/auth",
-    api_base_url="https://www.googleapis.com/oauth2/v1/",
-    client_kwargs={"scope": "openid email profile"},
-)
 class UserSignup(BaseModel):
     email: str
     password: str
@@ -73,171 +60,296 @@ class UserLogin(BaseModel):
     password: str
 
 
-@router.get("/health")
+class UserBatchLookup(BaseModel):
+    emails: List[str] = []
+    ids: List[int] = []
+
+
+@router.get("/health", response_model=StatusMessage, response_model_exclude_unset=True)
 async def health():
     return {"status": "ok"}
 
 
-@router.post("/signup")
-def create_new_user(user: UserSignup):
-    conn = None
-    try:
-        conn = pg_pool.getconn()
-        hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
+async def _fetch_user_by_email(db, email):
+    async with db.connection() as conn:
+        with timed("db_user_lookup"):
+            return await queries.fetch_login(conn, email)
 
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO users(email, password, username) VALUES (%s, %s, %s)",
-                (user.email, hashed_password, user.name)
-            )
-            conn.commit()
+
+@router.get("/email_available", response_model=EmailAvailability)
+async def email_available(email: str, db: AsyncConnectionPool = Depends(get_pool)):
+    """Whether ``email`` can still be used to sign up"""
+    return {"email": email, "available": not await email_index.email_exists(db, email)}
+
+
+@router.post("/signup", response_model=StatusMessage)
+async def create_new_user(user: UserSignup, request: Request, db: AsyncConnectionPool = Depends(get_pool)):
+    signup_ip_limiter.check(client_ip(request))
+    ensure_not_breached(user.password)
+    try:
+        # Taken emails are turned away before paying for bcrypt
+        if await email_index.email_exists(db, user.email):
+            return {"status": "fail", "message": "Email already registered"}
+
+        # Hash before taking a connection so the pool isn't held for the ~250 ms bcrypt call
+        hashed_password = await hash_password(user.password)
+        async with db.connection() as conn:
+            with timed("db_user_insert"):
+                await conn.execute(
+                    "INSERT INTO users(email, password, username) VALUES (%s, %s, %s)",
+                    (user.email, encode_stored_hash(hashed_password), user.name)
+                )
+                await conn.commit()
+        email_index.add(user.email)
+        await profile_cache.invalidate(db, user.email)
         return {"status": "success", "message": "User created successfully"}
+    except UniqueViolation:
+        # Lost a race with another signup for the same email
+        return {"status": "fail", "message": "Email already registered"}
+    except HTTPException:
+        raise
     except Exception as e:
         return {"status": "error", "message": str(e)}
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
 
 
-@router.post("/login")
-# @limiter.limit("5/minute") 
-def login(user: UserLogin, request: Request):
-    conn = None
-    try:
-        conn = pg_pool.getconn()
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE email = %s", (user.email,))
-            user_record = cur.fetchone()
-
-            if not user_record:
-                return {"status": "fail", "message": "Invalid email or password"}
-
-            if user_record[4] is True or user_record[3] is None:
-                return {
-                    "status": "fail", 
-                    "message": "This account uses Google Sign-In. Please use the 'Sign in with Google' button."
-                }
-
-            stored_hash_value = user_record[3]
-            stored_hash = (
-                stored_hash_value.tobytes()
-                if hasattr(stored_hash_value, 'tobytes')
-                else bytes.fromhex(stored_hash_value[2:])
-            )
+# Background rehashes given up on; the next login tries again
+_rehash_skipped = {"hash_busy": 0, "db_unavailable": 0, "db_error": 0}
 
-            user_input_password = user.password.encode('utf-8')
-            if bcrypt.checkpw(user_input_password, stored_hash):
-                access_token = create_access_token(
-                    data={"sub": str(user_record[0])},
-                    expires_delta=datetime.timedelta(minutes=60)
-                )
 
-                return {
-                    "status": "success",
-                    "message": "Login successful",
-                    "token": access_token
-                }
-            else:
-                return {"status": "fail", "message": "Invalid email or password"}
+async def _rehash_password(db, user_id, password, old_value):
+    """Re-store a password at the current cost and format after a successful login.
 
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
+    Runs after the response is sent, so a failure has no one to report to:
+    it's counted and dropped instead of surfacing as an unhandled task error.
+    """
+    try:
+        new_value = encode_stored_hash(await hash_password(password))
+        async with db.connection() as conn:
+            with timed("db_password_rehash"):
+                # Only if nobody changed the password since we read it
+                await conn.execute(
+                    "UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                    (new_value, user_id, old_value)
+                )
+                await conn.commit()
+    except DatabaseUnavailable:
+        _rehash_skipped["db_unavailable"] += 1
+    except HTTPException:
+        # hash_password's 503 when the hashing queue is full
+        _rehash_skipped["hash_busy"] += 1
+    except psycopg.Error:
+        _rehash_skipped["db_error"] += 1
+
+
+@gauge("password_rehash_skipped", "Background password rehashes dropped, by reason")
+def _rehashes_skipped():
+    return [({"reason": reason}, count) for reason, count in _rehash_skipped.items()]
+
+
+@router.post("/login", response_model=LoginResponse, response_model_exclude_unset=True)
+async def login(
+    user: UserLogin,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: AsyncConnectionPool = Depends(get_pool),
+):
+    ip = client_ip(request)
+    # Rejected attempts cost a few dict operations instead of a query and a bcrypt check
+    try:
+        guard_login(request, user.email)
+    except HTTPException:
+        audit.record("login", "blocked", email=user.email, ip=ip)
+        raise
+    try:
+        user_record = await _fetch_user_by_email(db, user.email)
 
+        if not user_record:
+            audit.record("login", "failure", email=user.email, ip=ip, detail="unknown email")
+            return {"status": "fail", "message": "Invalid email or password"}
 
+        if user_record.is_google_user is True or user_record.password is None:
+            audit.record("login", "failure", email=user.email, user_id=user_record.id, ip=ip, detail="google account")
+            return {
+                "status": "fail", 
+                "message": "This account uses Google Sign-In. Please use the 'Sign in with Google' button."
+            }
+
+        stored_hash = decode_stored_hash(user_record.password)
+
+        if await check_password(user.password, stored_hash):
+            clear_login_failures(user.email)
+            audit.record("login", "success", email=user.email, user_id=user_record.id, ip=ip)
+            if needs_rehash(user_record.password):
+                # After the response, so the user doesn't wait on a second bcrypt call
+                background_tasks.add_task(_rehash_password, db, user_record.id, user.password, user_record.password)
+            session_id, refresh_token = await start_session(db, user_record.id, str(user_record.id))
+            access_token = create_access_token(
+                data={"sub": str(user_record.id), "sid": session_id},
+                expires_delta=datetime.timedelta(minutes=60)
+            )
 
-@router.get("/user")
-def get():
-    conn = None
-    try:
-        conn = pg_pool.getconn()
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users")
-            user_record = cur.fetchall()
             return {
-                    "status": "success",
-                    "message": "Login successful",
-                    "users": user_record
-        }       
-          
-           
+                "status": "success",
+                "message": "Login successful",
+                "token": access_token,
+                "refresh_token": refresh_token
+            }
+        else:
+            record_login_failure(user.email)
+            audit.record("login", "failure", email=user.email, user_id=user_record.id, ip=ip, detail="wrong password")
+            return {"status": "fail", "message": "Invalid email or password"}
+
+    except HTTPException:
+        raise
     except Exception as e:
         return {"status": "error", "message": str(e)}
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
 
 
 
+USER_PAGE_MAX = 1000
+USER_STREAM_BATCH = 500
+USER_BATCH_MAX = int(os.getenv("USER_BATCH_MAX", "200"))
 
-@router.get("/user/{email}")
-def get_user(email: str):
-    conn = None
-    try:
-        conn = pg_pool.getconn()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            
-            cur.execute(
-                """
-                SELECT id, email, username, profile_picture, 
-                       is_google_user, mfa_enabled, created_at
-                FROM users
-                WHERE email = %s
-                """,
-                (email,)
+
+async def _stream_users(db, after_id):
+    async with db.connection() as conn:
+        # Named cursor = server-side cursor, so rows arrive USER_STREAM_BATCH at a time
+        async with conn.cursor(name="users_stream", row_factory=dict_row) as cur:
+            cur.itersize = USER_STREAM_BATCH
+            await cur.execute(
+                f"SELECT {USER_COLUMNS} FROM users WHERE id > %s ORDER BY id",
+                (after_id,)
             )
-            user_record = cur.fetchone()
+            async for row in cur:
+                yield orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
 
-            if not user_record:
-                raise HTTPException(status_code=404, detail="User not found")
 
-            return {
-                "status": "success",
-                "message": "User retrieved successfully",
-                "user": user_record
-            }
+@router.get("/user", response_model=UserPage, response_model_exclude_unset=True)
+async def get(
+    after_id: int = 0,
+    limit: int = Query(100, ge=1, le=USER_PAGE_MAX),
+    stream: bool = False,
+    db: AsyncConnectionPool = Depends(get_pool),
+):
+    """List users ordered by id, one page per call.
 
-    finally:
-        if conn:
-            pg_pool.putconn(conn)
+    Pass the returned ``next_cursor`` as ``after_id`` to get the next page.
+    With ``stream=true`` every user after ``after_id`` is sent as NDJSON.
+    """
+    if stream:
+        return StreamingResponse(_stream_users(db, after_id), media_type="application/x-ndjson")
+
+    try:
+        async with db.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(
+                    f"SELECT {USER_COLUMNS} FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                    (after_id, limit)
+                )
+                users = await cur.fetchall()
+        return {
+            "status": "success",
+            "message": "Users retrieved successfully",
+            "users": users,
+            "next_cursor": users[-1]["id"] if len(users) == limit else None,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
 
 
 
 
-@router.post("/delete")
-def delete_user(user: UserLogin):
-    conn = None
+@router.get("/user/{email}", response_model=UserResponse)
+async def get_user(
+    email: str,
+    response: Response,
+    if_none_match: str | None = Header(None),
+    db: AsyncConnectionPool = Depends(get_pool),
+):
+    """Served from the profile cache; send the ETag back in If-None-Match to get a 304"""
+    profile = await profile_cache.get_profile(db, email)
+
+    if profile is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    return profile_cache.cached_response(
+        {
+            "status": "success",
+            "message": "User retrieved successfully",
+            "user": profile.user
+        },
+        profile.user_etag,
+        if_none_match,
+        response,
+    )
+
+
+
+
+@router.post("/users/batch", response_model=UserBatchResponse, response_model_exclude_unset=True)
+async def get_users_batch(body: UserBatchLookup, db: AsyncConnectionPool = Depends(get_pool)):
+    """Resolve many users by email and/or id in one query.
+
+    ``results`` follows the request order, emails first, with ``"user": null``
+    for every miss.
+    """
+    if len(body.emails) + len(body.ids) > USER_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {USER_BATCH_MAX} emails and ids per request")
+
+    rows = []
+    if body.emails or body.ids:
+        async with db.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                with timed("db_user_batch_lookup"):
+                    await cur.execute(
+                        f"SELECT {USER_COLUMNS} FROM users WHERE email = ANY(%s) OR id = ANY(%s)",
+                        (body.emails, body.ids)
+                    )
+                    rows = await cur.fetchall()
+
+    by_email = {row["email"]: row for row in rows}
+    by_id = {row["id"]: row for row in rows}
+    results = [{"email": email, "user": by_email.get(email)} for email in body.emails]
+    results += [{"id": user_id, "user": by_id.get(user_id)} for user_id in body.ids]
+    return {
+        "status": "success",
+        "found": sum(result["user"] is not None for result in results),
+        "results": results,
+    }
+
+
+@router.post("/delete", response_model=StatusMessage)
+async def delete_user(user: UserLogin, request: Request, db: AsyncConnectionPool = Depends(get_pool)):
+    guard_login(request, user.email)
     try:
-        conn = pg_pool.getconn()
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE email = %s", (user.email,))
-            user_record = cur.fetchone()
-
-            if not user_record:
-                return {"status": "fail", "message": "User not found"}
-            
-            stored_hash_value = user_record[3]
-            
-            if stored_hash_value is None:
-                return {"status": "fail", "message": "Cannot delete Google accounts this way"}
-            
-            stored_hash = (
-                stored_hash_value.tobytes()
-                if hasattr(stored_hash_value, 'tobytes')
-                else bytes.fromhex(stored_hash_value[2:])
-            )
-            
-            if bcrypt.checkpw(user.password.encode('utf-8'), stored_hash):
-                cur.execute("DELETE FROM users WHERE email = %s", (user.email,))
-                conn.commit()
-                return {"status": "success", "message": "User deleted successfully"}
-            else:
-                return {"status": "fail", "message": "Invalid credentials"}
+        user_record = await _fetch_user_by_email(db, user.email)
+
+        if not user_record:
+            return {"status": "fail", "message": "User not found"}
+        
+        stored_hash_value = user_record.password
+        
+        if stored_hash_value is None:
+            return {"status": "fail", "message": "Cannot delete Google accounts this way"}
+        
+        stored_hash = decode_stored_hash(stored_hash_value)
+        
+        # The connection was returned above; only take one again if the password matches
+        if await check_password(user.password, stored_hash):
+            async with db.connection() as conn:
+                with timed("db_user_delete"):
+                    await conn.execute("DELETE FROM users WHERE email = %s", (user.email,))
+                    await conn.commit()
+            totp_verifier.invalidate(user.email)
+            await profile_cache.invalidate(db, user.email)
+            return {"status": "success", "message": "User deleted successfully"}
+        else:
+            record_login_failure(user.email)
+            return {"status": "fail", "message": "Invalid credentials"}
                 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"status": "error", "message": "An error occurred"}
-    finally:
-        if conn:
-            pg_pool.putconn(conn)